@@ -0,0 +1,102 @@
+"""Persisted, resumable message history backfill jobs"""
+
+import time
+from itertools import islice
+import database
+
+
+class BackfillProgress:
+    """Progress of a history backfill across several channels, shared by the concurrent per-channel scans."""
+    def __init__(self, channels_total, channels_done=0):
+        self.channels_total = channels_total
+        self.channels_done = channels_done
+        self.messages = 0
+        self.started = time.monotonic()
+        self.finished = False
+
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.messages / elapsed if elapsed > 0 else 0.0
+
+
+    def summary(self):
+        return f"Counting history... Channels done: {self.channels_done}/{self.channels_total}. " \
+               f"Messages counted: {self.messages} ({self.rate():.1f} messages/sec)"
+
+
+def create_job(conn, guild_id, scope, scope_id, stat_ids, after, channel_ids):
+    try:
+        cur = conn.execute("INSERT INTO backfill_jobs(guild_id, scope, scope_id, stat_ids, after) VALUES (?,?,?,?,?)",
+                           (guild_id, scope, scope_id, ','.join(str(stat_id) for stat_id in stat_ids), after.isoformat() if after else None))
+        job_id = cur.lastrowid
+        conn.executemany("INSERT INTO backfill_channels(job_id, channel_id) VALUES (?,?)", [(job_id, channel_id) for channel_id in channel_ids])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return job_id
+
+
+def checkpoint(conn, job_id, channel_id, last_message_id, counts, done=False, chunk_size=1000):
+    """Persist a channel's partial counts and the id of the last message they include in one transaction,
+    so a resumed job neither loses nor double counts messages. Counts are written in chunks of chunk_size rows."""
+    params = ((job_id, user_id, count) for user_id, count in counts.items())
+    try:
+        while chunk := list(islice(params, chunk_size)):
+            conn.executemany("""INSERT INTO backfill_counts(job_id, user_id, count) VALUES (?,?,?)
+                                ON CONFLICT(job_id, user_id) DO UPDATE SET count = count + excluded.count""", chunk)
+        conn.execute("""UPDATE backfill_channels SET last_message_id = COALESCE(?, last_message_id), done = ?
+                        WHERE job_id = ? AND channel_id = ?""", (last_message_id, int(done), job_id, channel_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def get_jobs(conn, guild_id=None, status=None):
+    """Return (id, guild_id, scope, scope_id, stat_ids, after, status, channels_done, channels_total) rows."""
+    sql = """SELECT j.id, j.guild_id, j.scope, j.scope_id, j.stat_ids, j.after, j.status,
+                    (SELECT COUNT(*) FROM backfill_channels c WHERE c.job_id = j.id AND c.done = 1),
+                    (SELECT COUNT(*) FROM backfill_channels c WHERE c.job_id = j.id)
+             FROM backfill_jobs j WHERE (? IS NULL OR j.guild_id = ?) AND (? IS NULL OR j.status = ?) ORDER BY j.id"""
+    return conn.execute(sql, (guild_id, guild_id, status, status)).fetchall()
+
+
+def get_job(conn, job_id):
+    """Return the job's row in the same layout as get_jobs, or None."""
+    sql = """SELECT j.id, j.guild_id, j.scope, j.scope_id, j.stat_ids, j.after, j.status,
+                    (SELECT COUNT(*) FROM backfill_channels c WHERE c.job_id = j.id AND c.done = 1),
+                    (SELECT COUNT(*) FROM backfill_channels c WHERE c.job_id = j.id)
+             FROM backfill_jobs j WHERE j.id = ?"""
+    return conn.execute(sql, (job_id,)).fetchone()
+
+
+def get_pending_channels(conn, job_id):
+    return conn.execute("SELECT channel_id, last_message_id FROM backfill_channels WHERE job_id = ? AND done = 0", (job_id,)).fetchall()
+
+
+def finish_job(conn, job_id, guild_id, stat_ids):
+    """Set each stat to the job's counted totals and mark the job done, all in one transaction. Returns the number of
+    rows written."""
+    counts = conn.execute("SELECT user_id, count FROM backfill_counts WHERE job_id = ?", (job_id,)).fetchall()
+    try:
+        rows = database.upsert_user_stats(conn, [(guild_id, stat_id, user_id, count) for stat_id in stat_ids for user_id, count in counts])
+        conn.execute("DELETE FROM backfill_counts WHERE job_id = ?", (job_id,))
+        conn.execute("UPDATE backfill_jobs SET status = 'done' WHERE id = ?", (job_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return rows
+
+
+def end_job(conn, job_id, status):
+    """Stop a job without applying its counts, e.g. when it is cancelled or fails."""
+    try:
+        conn.execute("DELETE FROM backfill_counts WHERE job_id = ?", (job_id,))
+        conn.execute("UPDATE backfill_jobs SET status = ? WHERE id = ?", (status, job_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
@@ -0,0 +1 @@
+"""Offline benchmarks of the bot's hot paths, see run.py"""
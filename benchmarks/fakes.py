@@ -0,0 +1,132 @@
+"""Minimal stand-ins for the discord.py objects the bot's hot paths use"""
+
+import datetime
+from bisect import bisect_right
+from typing import NamedTuple
+import discord
+
+
+class FakeHTTPResponse(NamedTuple):
+    """The parts of an aiohttp response that discord.HTTPException reads."""
+    status: int
+    reason: str
+
+
+class FakeUser(NamedTuple):
+    id: int
+    name: str
+    bot: bool = False
+
+
+class FakeEmoji(NamedTuple):
+    id: int
+    name: str
+
+
+class FakeCategory(NamedTuple):
+    id: int
+    name: str
+
+
+class FakeGuild:
+    def __init__(self, guild_id, members, categories, emojis):
+        self.id = guild_id
+        self.members = {member.id: member for member in members}
+        self.categories = categories
+        self.emojis = emojis
+
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+
+    async def fetch_emoji(self, emoji_id):
+        # Emojis are only fetched when they are not in the guild, which the API answers with a 404
+        raise discord.NotFound(FakeHTTPResponse(404, "Not Found"), {'code': 10014, 'message': "Unknown Emoji"})
+
+
+class FakeMessage:
+    def __init__(self, message_id, author, channel, content="", created_at=None):
+        self.id = message_id
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.created_at = created_at or datetime.datetime.now(datetime.UTC)
+
+
+class FakeChannel:
+    """A text channel whose history is a prebuilt list of FakeMessages, oldest first."""
+    def __init__(self, channel_id, name, guild, category_id=None, slowmode_delay=0):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.category_id = category_id
+        self.slowmode_delay = slowmode_delay
+        self.messages = []
+
+
+    async def history(self, limit=None, after=None, oldest_first=False):
+        # after is a datetime or, like discord.Object, anything with the id of a message. Messages are in id order.
+        start = 0
+        if isinstance(after, datetime.datetime):
+            start = bisect_right(self.messages, after, key=lambda message: message.created_at)
+        elif after is not None:
+            start = bisect_right(self.messages, after.id, key=lambda message: message.id)
+        messages = self.messages[start:] if oldest_first else self.messages[start:][::-1]
+        for message in messages[:limit]:
+            yield message
+
+
+    async def send(self, *args, **kwargs):
+        pass
+
+
+class FakeResponse:
+    def __init__(self):
+        self.done = False
+
+
+    def is_done(self):
+        return self.done
+
+
+    async def send_message(self, *args, **kwargs):
+        self.done = True
+
+
+class FakeInteraction:
+    def __init__(self, guild, channel, user):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel = channel
+        self.user = user
+        self.response = FakeResponse()
+        self.extras = {}
+        self.created_at = datetime.datetime.now(datetime.UTC)
+
+
+    async def edit_original_response(self, *args, **kwargs):
+        pass
+
+
+    async def delete_original_response(self):
+        pass
+
+
+class FakePartialEmoji(NamedTuple):
+    id: int
+
+
+class FakeReactionEvent:
+    def __init__(self, guild_id, emoji_id):
+        self.guild_id = guild_id
+        self.emoji = FakePartialEmoji(emoji_id)
+
+
+class FakeCommand:
+    """An app command that counts as a message, like the bot's own commands tagged with behave_as_message."""
+    def __init__(self, name):
+        self.name = name
+        self.qualified_name = name
+        self.extras = {'behave_as_message': True}
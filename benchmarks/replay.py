@@ -0,0 +1,203 @@
+"""Replay of a recorded gateway event trace through the bot's handlers
+
+Feeds the events of a trace recorded with LEADERBOARDS_BOT_TRACE_FILE to the same handlers the gateway would call,
+against a scratch database, at the recorded pace, a multiple of it, or as fast as the handlers accept them:
+
+    python -m benchmarks.replay events.jsonl.gz --speed 10
+
+Guilds, channels, members and emojis are rebuilt from the ids in the trace. Each guild gets total message stats for
+the guild, its busiest category and its busiest channel, unless --mapping-db copies the stats of the guilds from a
+real database, which only matches traces that were not anonymized. Prints one JSON object with the results.
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+from json import dumps, loads
+from os.path import join
+from benchmarks.fakes import FakeUser, FakeEmoji, FakeCategory, FakeGuild, FakeChannel, FakeMessage, FakeInteraction, FakeReactionEvent, FakeCommand
+from benchmarks.run import main, setup_client, percentile
+import tracing
+
+
+def parse_speed(value):
+    """Return the speed multiplier, or None to replay as fast as possible."""
+    if value == 'max':
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("Speed must be positive or 'max'")
+    return speed
+
+
+def build_guilds(path):
+    """Rebuild the guilds of a trace, with channels and categories ordered from most to least messages."""
+    channels = {}
+    channel_messages = {}
+    category_messages = {}
+    members = {}
+    emojis = {}
+    for event in tracing.read_trace(path):
+        kind, guild_id = event[1], event[2]
+        guild_emojis = emojis.setdefault(guild_id, set())
+        if kind in (tracing.MESSAGE, tracing.COMMAND):
+            channel_id, category_id, user_id = event[3], event[4], event[5]
+            channels.setdefault(guild_id, {})[channel_id] = category_id
+            members.setdefault(guild_id, set()).add(user_id)
+            channel_messages.setdefault(guild_id, Counter())[channel_id] += 1
+            if category_id is not None:
+                category_messages.setdefault(guild_id, Counter())[category_id] += 1
+            if kind == tracing.MESSAGE:
+                guild_emojis.update(event[7])
+        else:
+            guild_emojis.add(event[3])
+
+    guilds = []
+    for guild_id, guild_emojis in emojis.items():
+        categories = [FakeCategory(category_id, f"category{i}") for i, (category_id, _) in enumerate(category_messages.get(guild_id, Counter()).most_common())]
+        # Messages in a trace can contain emojis of other guilds, these are treated as the guild's own
+        guild = FakeGuild(guild_id, [FakeUser(user_id, f"user{i}") for i, user_id in enumerate(members.get(guild_id, ()))], categories,
+                          [FakeEmoji(emoji_id, f"emoji{i}") for i, emoji_id in enumerate(sorted(guild_emojis))])
+        guild.channels = [FakeChannel(channel_id, f"channel{i}", guild, channels[guild_id][channel_id])
+                          for i, (channel_id, _) in enumerate(channel_messages.get(guild_id, Counter()).most_common())]
+        guild.emoji_names = {emoji.id: emoji.name for emoji in guild.emojis}
+        guilds.append(guild)
+    return guilds
+
+
+def trace_stat_mapping(guild, num_stats):
+    """Total message stats of the guild, then its busiest category and channel, for as many as the guild has."""
+    levels = [('Guild', guild.id)]
+    if guild.categories:
+        levels.append(('Category', guild.categories[0].id))
+    if guild.channels:
+        levels.append(('Channel', guild.channels[0].id))
+    mapping = [{'Type': 'total_messages', 'Level': level, 'LevelID': level_id, 'StatID': i + 1}
+               for i, (level, level_id) in enumerate(levels[:num_stats])]
+    return {'Mapping': mapping, 'NextStatID': len(mapping) + 1}
+
+
+def read_mappings(db_path, guild_ids):
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("SELECT id, stat_mapping FROM guilds").fetchall()
+    finally:
+        conn.close()
+    return {guild_id: loads(mapping) for guild_id, mapping in rows if guild_id in guild_ids and mapping}
+
+
+def message_content(guild, emoji_ids):
+    return "replayed " + " ".join(f"<:{guild.emoji_names[emoji_id]}:{emoji_id}>" for emoji_id in emoji_ids)
+
+
+def dispatch(client, event, message_id):
+    """Return the handler call for an event, or None if it refers to something that was not rebuilt."""
+    kind, guild_id = event[1], event[2]
+    guild = client.get_guild(guild_id)
+    if guild is None:
+        return None
+
+    if kind == tracing.REACTION_ADD:
+        return main.on_raw_reaction_add(FakeReactionEvent(guild_id, event[3]))
+    if kind == tracing.REACTION_REMOVE:
+        return main.on_raw_reaction_remove(FakeReactionEvent(guild_id, event[3]))
+
+    channel = client.get_channel(event[3])
+    author = guild.get_member(event[5])
+    # Slow mode can change during a recording, the channel takes the delay of each event in turn
+    channel.slowmode_delay = event[6] or 0
+    if kind == tracing.MESSAGE:
+        return main.on_message(FakeMessage(message_id, author, channel, message_content(guild, event[7])))
+    if kind == tracing.COMMAND:
+        return main.on_app_command_completion(FakeInteraction(guild, channel, author), FakeCommand(event[7]))
+    return None
+
+
+async def replay(args):
+    guilds = build_guilds(args.trace)
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        db_path = args.db or join(db_dir, f"replay-{os.getpid()}.db")
+        mappings = read_mappings(args.mapping_db, {guild.id for guild in guilds}) if args.mapping_db else {}
+        for guild in guilds:
+            mappings.setdefault(guild.id, trace_stat_mapping(guild, args.stats))
+        client = setup_client(db_path, guilds, args.stats, mappings)
+        client.ingest_queue.start(main.process_ingested_event, client.ingest_workers)
+        flush_task = asyncio.create_task(client.flush_stats_periodically())
+
+        kinds = Counter()
+        latencies = []
+        max_lag = 0.0
+        recorded_ms = 0
+        started = time.perf_counter()
+        for message_id, event in enumerate(tracing.read_trace(args.trace)):
+            recorded_ms = event[0]
+            if args.speed is not None:
+                delay = event[0] / 1000 / args.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    max_lag = max(max_lag, -delay)
+            else:
+                # Give the ingestion workers and background tasks a turn, as the gateway would between events
+                await asyncio.sleep(0)
+
+            call = dispatch(client, event, message_id)
+            if call is None:
+                kinds['skipped'] += 1
+                continue
+            call_started = time.perf_counter()
+            await call
+            latencies.append(time.perf_counter() - call_started)
+            kinds[event[1]] += 1
+
+        dispatched = time.perf_counter() - started
+        await client.ingest_queue.queue.join()
+        await client.ingest_queue.stop()
+        flush_task.cancel()
+        main.flush_user_stats()
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        result = {
+            'trace': args.trace,
+            'speed': args.speed or 'max',
+            'events': dict(kinds),
+            'guilds': len(guilds),
+            'recorded_seconds': recorded_ms / 1000,
+            'dispatch_seconds': dispatched,
+            'elapsed_seconds': elapsed,
+            'events_per_second': len(latencies) / elapsed if elapsed > 0 else 0.0,
+            'max_lag_ms': max_lag * 1000,
+            'handler_p50_ms': percentile(latencies, 0.50) * 1000,
+            'handler_p99_ms': percentile(latencies, 0.99) * 1000,
+            'ingest': client.ingest_queue.stats(),
+            'stat_buffer': client.stat_buffer.stats(),
+            'slow_mode': client.slow_mode.stats(),
+            'rest': client.rest.stats(),
+            'db': client.db.stats()
+        }
+        client.db.close()
+    print(dumps(result))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Replay a recorded gateway event trace through the bot's handlers offline.")
+    parser.add_argument('trace', help="Trace file recorded with LEADERBOARDS_BOT_TRACE_FILE")
+    parser.add_argument('--speed', type=parse_speed, default=1.0, help="Multiple of the recorded pace, e.g. 1 or 10, or 'max'")
+    parser.add_argument('--db', default=None, help="Scratch database path, a temporary one is used if not given. Must not exist yet.")
+    parser.add_argument('--stats', type=int, default=3, help="Generated stats per guild: guild, busiest category, busiest channel")
+    parser.add_argument('--mapping-db', default=None, help="Copy the stats of the traced guilds from this database instead")
+    args = parser.parse_args()
+    if args.db and os.path.exists(args.db):
+        sys.exit(f"Refusing to replay into the existing database {args.db}")
+    asyncio.run(replay(args))
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,260 @@
+"""Offline benchmarks of the bot's hot paths
+
+Drives the real functions of main.py with fake Discord objects against a temporary database, for every combination
+of the swept parameters, and prints one JSON object per path and combination:
+
+    python -m benchmarks.run --guilds 1,10 --users 100,1000 --stats 1,3 --emojis 0,3 --output results.jsonl
+
+No network access or bot token is needed.
+"""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import os
+import sys
+import tempfile
+import time
+from json import dumps
+from os.path import join
+from random import Random
+from benchmarks.fakes import FakeUser, FakeEmoji, FakeCategory, FakeGuild, FakeChannel, FakeMessage, FakeInteraction
+
+
+# main.py reads the database path from its command line arguments on import
+_argv = sys.argv
+sys.argv = sys.argv[:1]
+import main
+sys.argv = _argv
+import backfill
+import ingestion
+import migrations
+
+
+BOT_USER = FakeUser(1, "LeaderboardsBot", True)
+CHANNELS_PER_GUILD = 4
+
+
+class BenchBot(main.LeaderboardsBot):
+    """LeaderboardsBot whose user, guilds and channels are fakes, so nothing needs a gateway connection."""
+    user = BOT_USER
+
+    def __init__(self, config_settings, guilds):
+        super().__init__(config_settings)
+        self.fake_guilds = {guild.id: guild for guild in guilds}
+        self.fake_channels = {channel.id: channel for guild in guilds for channel in guild.channels}
+
+
+    def get_guild(self, guild_id):
+        return self.fake_guilds.get(guild_id)
+
+
+    def get_channel(self, channel_id):
+        return self.fake_channels.get(channel_id)
+
+
+    def get_user(self, user_id):
+        return None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(path, params, latencies, elapsed, units=None):
+    """Build the result record of a path. Throughput is in operations per second, or units per second if given."""
+    latencies = sorted(latencies)
+    return {
+        'path': path,
+        'params': params,
+        'ops': len(latencies),
+        'throughput': (units if units is not None else len(latencies)) / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0
+    }
+
+
+async def measure(calls):
+    """Await each zero-argument callable in turn, timing every call. Returns (latencies, elapsed)."""
+    latencies = []
+    started = time.perf_counter()
+    for call in calls:
+        call_started = time.perf_counter()
+        result = call()
+        if asyncio.iscoroutine(result):
+            await result
+        latencies.append(time.perf_counter() - call_started)
+    return latencies, time.perf_counter() - started
+
+
+def build_guilds(num_guilds, users_per_guild, num_emojis):
+    guilds = []
+    for g in range(num_guilds):
+        guild_id = 10 ** 17 + g * 10 ** 6
+        members = [FakeUser(guild_id + 1000 + u, f"user{u}") for u in range(users_per_guild)]
+        categories = [FakeCategory(guild_id + 1, "Category")]
+        emojis = [FakeEmoji(guild_id + 500 + e, f"emoji{e}") for e in range(max(num_emojis, 1))]
+        guild = FakeGuild(guild_id, members, categories, emojis)
+        guild.channels = [FakeChannel(guild_id + 10 + c, f"channel{c}", guild, categories[0].id) for c in range(CHANNELS_PER_GUILD)]
+        guilds.append(guild)
+    return guilds
+
+
+def stat_mapping(guild, num_stats):
+    """Total message stats cycling through guild, category and channel level."""
+    mapping = []
+    for i in range(num_stats):
+        level = ('Guild', 'Category', 'Channel')[i % 3]
+        level_id = {'Guild': guild.id, 'Category': guild.categories[0].id, 'Channel': guild.channels[0].id}[level]
+        mapping.append({'Type': 'total_messages', 'Level': level, 'LevelID': level_id, 'StatID': i + 1})
+    return {'Mapping': mapping, 'NextStatID': num_stats + 1}
+
+
+def setup_client(db_path, guilds, num_stats, mappings=None):
+    """Create the bot against a fresh database at db_path. Guilds get num_stats generated stats, or their entry in
+    mappings, a dict of guild id to stat mapping, if given."""
+    config = dict(main.config_vars, DB_PATH=db_path, INGEST_SPILL_PATH=db_path + ".spill", HEALTH_FILE=None, TRACE_FILE=None)
+    client = BenchBot(config, guilds)
+    main.client = client
+    main.synced_guilds.update(guild.id for guild in guilds)
+
+    if mappings is None:
+        mappings = {guild.id: stat_mapping(guild, num_stats) for guild in guilds}
+    conn = client.db.acquire()
+    migrations.migrate(conn)
+    conn.executemany("INSERT INTO guilds(id, stat_mapping) VALUES (?,?)", [(guild_id, dumps(mapping)) for guild_id, mapping in mappings.items()])
+    conn.commit()
+    client.db.release(conn)
+    return client
+
+
+def message_content(guild, num_emojis):
+    return "hello " + " ".join(f"<:{emoji.name}:{emoji.id}>" for emoji in guild.emojis[:num_emojis])
+
+
+async def bench_combination(params, ops, history_messages, db_dir):
+    rng = Random(0)
+    guilds = build_guilds(params['guilds'], params['users'], params['emojis'])
+    client = setup_client(join(db_dir, f"bench-{os.getpid()}-{time.monotonic_ns()}.db"), guilds, params['stats'])
+    results = []
+
+    def random_author(guild):
+        return rng.choice(list(guild.members.values()))
+
+    # get_stat_col: matching a message to the guild's stats
+    events = [(channel, main.get_guild_config(guild.id).stat_index) for guild in guilds for channel in guild.channels]
+    calls = [lambda event=rng.choice(events): main.get_stat_col(event[0], event[1], "total_messages") for _ in range(ops)]
+    results.append(summarize('get_stat_col', params, *await measure(calls)))
+
+    # update_user_stat: buffered increments, including the flushes they trigger
+    calls = []
+    for _ in range(ops):
+        guild = rng.choice(guilds)
+        calls.append(lambda guild=guild, user=random_author(guild): main.update_user_stat(user.id, guild.id, 1, "increment"))
+    results.append(summarize('update_user_stat', params, *await measure(calls)))
+    main.flush_user_stats()
+
+    # update_emote_count
+    calls = []
+    for _ in range(ops):
+        guild = rng.choice(guilds)
+        calls.append(lambda guild=guild, emoji=rng.choice(guild.emojis): main.update_emote_count(guild.id, emoji.id, True))
+    results.append(summarize('update_emote_count', params, *await measure(calls)))
+
+    # on_message: the gateway handler, plus the ingestion workers draining its records
+    client.ingest_queue.start(main.process_ingested_event, client.ingest_workers)
+    messages = []
+    for i in range(ops):
+        guild = rng.choice(guilds)
+        messages.append(FakeMessage(i, random_author(guild), rng.choice(guild.channels), message_content(guild, params['emojis'])))
+    started = time.perf_counter()
+    latencies, _ = await measure([lambda message=message: main.on_message(message) for message in messages])
+    await client.ingest_queue.queue.join()
+    results.append(summarize('on_message', params, latencies, time.perf_counter() - started))
+    await client.ingest_queue.stop()
+
+    # process_ingested_event: the database side of on_message, one record at a time
+    records = []
+    for message in messages:
+        records.append(ingestion.MessageRecord(message.guild.id, message.channel.id, message.channel.category_id, message.author.id,
+                                               [emoji.id for emoji in message.guild.emojis[:params['emojis']]]))
+    calls = [lambda record=record: main.process_ingested_event(record) for record in records]
+    results.append(summarize('process_ingested_event', params, *await measure(calls)))
+    main.flush_user_stats()
+
+    # display_leaderboard: served from the in-memory board after the first call of each guild
+    calls = []
+    for _ in range(max(1, ops // 10)):
+        guild = rng.choice(guilds)
+        calls.append(lambda guild=guild: main.display_leaderboard(FakeInteraction(guild, guild.channels[0], random_author(guild)), 1))
+    results.append(summarize('display_leaderboard', params, *await measure(calls)))
+
+    # _count_channel_history: counting and checkpointing a channel's history
+    channel = guilds[0].channels[0]
+    now = datetime.datetime.now(datetime.UTC)
+    channel.messages = [FakeMessage(i, random_author(guilds[0]), channel, created_at=now - datetime.timedelta(seconds=history_messages - i))
+                        for i in range(history_messages)]
+    conn = client.db.acquire()
+    job_id = backfill.create_job(conn, guilds[0].id, 'Channel', channel.id, [1], None, [channel.id])
+    client.db.release(conn)
+    users = {}
+
+    async def count_history():
+        await main._count_channel_history(channel, users, checkpoint=lambda last_message_id, done: main.write_backfill_checkpoint(job_id, channel.id, last_message_id, users, done),
+                                          checkpoint_every=client.backfill_checkpoint_messages, spill_users=client.backfill_spill_users)
+    latencies, elapsed = await measure([count_history])
+    results.append(summarize('_count_channel_history', params, latencies, elapsed, units=history_messages))
+
+    # delete_stat_from_db: removing the last stat of each guild, purges run in the background
+    calls = []
+    for guild in guilds:
+        config = main.get_guild_config(guild.id)
+        stat_id = config.stat_mapping['Mapping'][-1]['StatID']
+        calls.append(lambda guild=guild, stat_id=stat_id:
+                     main.delete_stat_from_db(FakeInteraction(guild, guild.channels[0], random_author(guild)), stat_id))
+    results.append(summarize('delete_stat_from_db', params, *await measure(calls)))
+    # Let the background purges finish before the database is closed
+    while any(not task.done() for task in asyncio.all_tasks() if task is not asyncio.current_task()):
+        await asyncio.sleep(0.01)
+
+    client.db.close()
+    return results
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(',')]
+
+
+async def run(args):
+    keys = ('guilds', 'users', 'stats', 'emojis')
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        with tempfile.TemporaryDirectory() as db_dir:
+            for values in itertools.product(args.guilds, args.users, args.stats, args.emojis):
+                params = dict(zip(keys, values))
+                for result in await bench_combination(params, args.ops, args.history_messages, db_dir):
+                    output.write(dumps(result) + '\n')
+                    output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's hot paths offline with fake Discord objects.")
+    parser.add_argument('--guilds', type=parse_ints, default=[1, 10], help="Comma separated guild counts to sweep")
+    parser.add_argument('--users', type=parse_ints, default=[100, 1000], help="Comma separated users per guild to sweep")
+    parser.add_argument('--stats', type=parse_ints, default=[1, 3], help="Comma separated stats per guild to sweep")
+    parser.add_argument('--emojis', type=parse_ints, default=[0, 3], help="Comma separated custom emojis per message to sweep")
+    parser.add_argument('--ops', type=int, default=2000, help="Operations per path and combination")
+    parser.add_argument('--history-messages', type=int, default=20000, help="Messages in the channel history scan")
+    parser.add_argument('--output', default=None, help="Write JSON lines here instead of stdout")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main_cli()
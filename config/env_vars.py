@@ -31,6 +31,40 @@ prod_vars = {
     'DB_PATH': join(getcwd(), "db", "leaderboards.db"),
     'BOT_COLOR': 0xF04747,
     'MAX_STATS_PER_GUILD': 3,
+    'STAT_PURGE_BATCH_SIZE': 1000,
+    'MIGRATION_BATCH_SIZE': 1000,
+    'DB_PRAGMAS': {},
+    'STAT_FLUSH_MAX_PENDING': 500,
+    'STAT_FLUSH_MAX_STALENESS': 5.0,
+    'LEADERBOARD_CACHE_SIZE': 25,
+    'RENDER_CACHE_SIZE': 1000,
+    'RENDER_CACHE_FRESHNESS': 5,
+    'RENDER_CACHE_MAX_AGE': 300,
+    'USER_NAME_CACHE_SIZE': 10000,
+    'USER_NAME_CACHE_TTL': 3600,
+    'USER_FETCH_CONCURRENCY': 4,
+    'HISTORY_CONCURRENCY': 8,
+    'REST_BACKGROUND_CONCURRENCY': 2,
+    'REST_BACKGROUND_MAX_WAIT': 5.0,
+    'HISTORY_PROGRESS_INTERVAL': 10,
+    'BACKFILL_CHECKPOINT_MESSAGES': 10000,
+    'BACKFILL_SPILL_USERS': 2000,
+    'ROLLUP_HOURLY_RETENTION_HOURS': 48,
+    'ROLLUP_DAILY_RETENTION_DAYS': 35,
+    'ROLLUP_COMPACT_INTERVAL': 3600,
+    'COMMAND_SYNC_CONCURRENCY': 4,
+    'COMMAND_SYNC_RETRIES': 3,
+    'COMMAND_SYNC_BACKOFF': 2.0,
+    'SHARD_IDS': None,
+    'SHARD_COUNT': None,
+    'HEALTH_FILE': None,
+    'HEALTH_REPORT_INTERVAL': 15,
+    'TRACE_FILE': None,
+    'TRACE_ANONYMIZE': False,
+    'INGEST_QUEUE_SIZE': 10000,
+    'INGEST_WORKERS': 4,
+    'INGEST_OVERFLOW_POLICY': 'block',
+    'INGEST_SPILL_PATH': join(getcwd(), "db", "ingest_spill.jsonl"),
     'BOT_TOKEN': getenv('PROD_LEADERBOARDS_BOT_TOKEN'),
     'INTENTS': _intents
 }
@@ -39,6 +73,40 @@ dev_vars = {
     'DB_PATH': join(getcwd(), "db", "dev_leaderboards.db"),
     'BOT_COLOR': 0x2EB684,
     'MAX_STATS_PER_GUILD': 3,
+    'STAT_PURGE_BATCH_SIZE': 1000,
+    'MIGRATION_BATCH_SIZE': 1000,
+    'DB_PRAGMAS': {},
+    'STAT_FLUSH_MAX_PENDING': 500,
+    'STAT_FLUSH_MAX_STALENESS': 5.0,
+    'LEADERBOARD_CACHE_SIZE': 25,
+    'RENDER_CACHE_SIZE': 1000,
+    'RENDER_CACHE_FRESHNESS': 5,
+    'RENDER_CACHE_MAX_AGE': 300,
+    'USER_NAME_CACHE_SIZE': 10000,
+    'USER_NAME_CACHE_TTL': 3600,
+    'USER_FETCH_CONCURRENCY': 4,
+    'HISTORY_CONCURRENCY': 8,
+    'REST_BACKGROUND_CONCURRENCY': 2,
+    'REST_BACKGROUND_MAX_WAIT': 5.0,
+    'HISTORY_PROGRESS_INTERVAL': 10,
+    'BACKFILL_CHECKPOINT_MESSAGES': 10000,
+    'BACKFILL_SPILL_USERS': 2000,
+    'ROLLUP_HOURLY_RETENTION_HOURS': 48,
+    'ROLLUP_DAILY_RETENTION_DAYS': 35,
+    'ROLLUP_COMPACT_INTERVAL': 3600,
+    'COMMAND_SYNC_CONCURRENCY': 4,
+    'COMMAND_SYNC_RETRIES': 3,
+    'COMMAND_SYNC_BACKOFF': 2.0,
+    'SHARD_IDS': None,
+    'SHARD_COUNT': None,
+    'HEALTH_FILE': None,
+    'HEALTH_REPORT_INTERVAL': 15,
+    'TRACE_FILE': None,
+    'TRACE_ANONYMIZE': False,
+    'INGEST_QUEUE_SIZE': 10000,
+    'INGEST_WORKERS': 4,
+    'INGEST_OVERFLOW_POLICY': 'block',
+    'INGEST_SPILL_PATH': join(getcwd(), "db", "dev_ingest_spill.jsonl"),
     'BOT_TOKEN': getenv('DEV_LEADERBOARDS_BOT_TOKEN'),
     'INTENTS': _intents
 }
@@ -0,0 +1,89 @@
+"""Database connection management"""
+
+import sqlite3
+
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,  # 256 MiB
+    'cache_size': -65536,  # Negative values are KiB, so 64 MiB
+    'busy_timeout': 5000,  # Milliseconds
+    'temp_store': 'MEMORY'
+}
+
+
+class ConnectionManager:
+    """Owns a long-lived, tuned sqlite3 connection that is reused for every database operation.
+    The bot runs on a single event loop thread so one connection is enough; it is reopened lazily if it is ever closed."""
+    def __init__(self, db_path, pragmas=None, cached_statements=256):
+        self.db_path = db_path
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+        self.cached_statements = cached_statements
+        self._conn = None
+        self.connects = 0
+        self.ops = 0
+        self.rollbacks = 0
+
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_path, cached_statements=self.cached_statements)
+        for pragma, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        self.connects += 1
+        return conn
+
+
+    def acquire(self):
+        """Return the shared connection, opening it if necessary. Pair every call with release()."""
+        if self._conn is None:
+            self._conn = self._open()
+        self.ops += 1
+        return self._conn
+
+
+    def release(self, conn):
+        """Finish an operation on the shared connection. Anything left uncommitted (e.g. after an error) is rolled back
+        so that the next operation starts clean."""
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+            self.rollbacks += 1
+
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.execute("PRAGMA optimize")
+            except sqlite3.Error as e:
+                print(f"Failed to optimize database on close. Error: {e}")
+            self._conn.close()
+            self._conn = None
+
+
+    def stats(self):
+        return {'connects': self.connects, 'ops': self.ops, 'rollbacks': self.rollbacks}
+
+
+def upsert_user_stats(conn, rows, add=False):
+    """Write (guild_id, stat_id, user_id, value) rows to user_stats with one executemany. Each value replaces the stored
+    one, or is added to it if add is True. The caller commits. Returns the number of rows written."""
+    if add:
+        sql = """  INSERT INTO user_stats(guild_id, stat_id, user_id, value) VALUES(?,?,?,?)
+                   ON CONFLICT(guild_id, stat_id, user_id) DO UPDATE SET value = value + excluded.value
+              """
+    else:
+        sql = """  INSERT INTO user_stats(guild_id, stat_id, user_id, value) VALUES(?,?,?,?)
+                   ON CONFLICT(guild_id, stat_id, user_id) DO UPDATE SET value = excluded.value
+              """
+    return conn.executemany(sql, rows).rowcount
+
+
+def purge_stat(conn, guild_id, stat_id, batch_size=1000):
+    """Delete up to batch_size rows of a deleted stat. Returns the number of rows deleted, 0 once the stat is gone."""
+    cur = conn.execute("""DELETE FROM user_stats WHERE guild_id = ? AND stat_id = ? AND user_id IN
+                              (SELECT user_id FROM user_stats WHERE guild_id = ? AND stat_id = ? LIMIT ?)""",
+                       (guild_id, stat_id, guild_id, stat_id, batch_size))
+    conn.commit()
+    return cur.rowcount
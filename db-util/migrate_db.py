@@ -0,0 +1,50 @@
+""" Apply pending schema migrations to an existing database """
+
+import argparse
+import sqlite3
+import sys
+import time
+from os import getcwd
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+import migrations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations in small batches, so a running bot can keep using the database.")
+    parser.add_argument('db_path', nargs='?', default=join(dirname(getcwd()), "db", "leaderboards.db"))
+    parser.add_argument('--dry-run', action='store_true', help="Only print the pending migrations and how many rows each would touch")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Rows copied per transaction")
+    parser.add_argument('--pause', type=float, default=0.05, help="Seconds to wait between batches")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db_path, timeout=30)
+    try:
+        print(f"Database schema version: {migrations.get_version(conn)}")
+        pending = migrations.plan(conn)
+        if not pending:
+            print("No pending migrations.")
+            return
+
+        for version, description, rows in pending:
+            print(f"  {version}: {description} (~{rows} rows)")
+        if args.dry_run:
+            return
+
+        started = time.monotonic()
+        total = 0
+        current = None
+        for version, rows in migrations.iter_migrate(conn, args.batch_size):
+            if version != current:
+                print(f"Applying migration {version}...")
+                current = version
+            total += rows
+            time.sleep(args.pause)
+        print(f"Migrated to version {migrations.get_version(conn)}, {total} rows in {time.monotonic() - started:.1f}s")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Local registry of guild custom emojis"""
+
+import re
+
+
+CUSTOM_EMOJI_PATTERN = re.compile(r'<a?:\w+:(\d+)>')
+
+
+def parse_custom_emoji_ids(content):
+    """Return the ids of the custom emojis in a message, once each. Malformed tokens such as <:x:> are ignored."""
+    return list(dict.fromkeys(int(emoji_id) for emoji_id in CUSTOM_EMOJI_PATTERN.findall(content)))
+
+
+class EmojiRegistry:
+    """Maps guild_id -> {emoji_id: name} for custom emojis, seeded from guild.emojis and replaced on every
+    on_guild_emojis_update. Ids confirmed absent from a guild (e.g. emojis from other servers) are remembered until the
+    guild's emojis next change so they do not trigger repeated REST lookups."""
+    def __init__(self):
+        self.guilds = {}
+        self.missing = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def is_seeded(self, guild_id):
+        return guild_id in self.guilds
+
+
+    def seed(self, guild_id, emojis):
+        self.guilds[guild_id] = {emoji.id: emoji.name for emoji in emojis}
+        self.missing[guild_id] = set()
+
+
+    def remove_guild(self, guild_id):
+        self.guilds.pop(guild_id, None)
+        self.missing.pop(guild_id, None)
+
+
+    def get_name(self, guild_id, emoji_id):
+        name = self.guilds.get(guild_id, {}).get(emoji_id)
+        if name is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return name
+
+
+    def is_missing(self, guild_id, emoji_id):
+        return emoji_id in self.missing.get(guild_id, ())
+
+
+    def add(self, guild_id, emoji_id, name):
+        self.guilds.setdefault(guild_id, {})[emoji_id] = name
+        self.missing.get(guild_id, set()).discard(emoji_id)
+
+
+    def mark_missing(self, guild_id, emoji_id):
+        self.missing.setdefault(guild_id, set()).add(emoji_id)
+
+
+    def stats(self):
+        return {'guilds': len(self.guilds), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,81 @@
+"""In-memory cache of per-guild configuration"""
+
+from json import loads
+from stat_index import StatIndex
+
+
+def parse_config_roles(config_roles):
+    if not config_roles:
+        return []
+    return [int(v) for v in config_roles.split(',')]
+
+
+class GuildConfig:
+    """Parsed configuration row of the guilds table. The stat_mapping object is shared by all readers and must not be mutated;
+    copy it and store the result through GuildConfigCache.set_stat_mapping instead."""
+    def __init__(self, guild_id, stat_mapping, config_roles, default_leaderboard):
+        self.guild_id = guild_id
+        self.stat_mapping = stat_mapping
+        self.stat_index = StatIndex(stat_mapping)
+        self.config_roles = config_roles
+        self.default_leaderboard = default_leaderboard
+
+
+class GuildConfigCache:
+    """Process-wide cache of GuildConfig objects. Filled lazily per guild or in bulk, and updated in place whenever the bot
+    writes guild configuration so that message handling never has to read the guilds table."""
+    def __init__(self):
+        self.configs = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, guild_id):
+        config = self.configs.get(guild_id)
+        if config is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return config
+
+
+    def _load_row(self, row):
+        config = GuildConfig(row[0], loads(row[1]), parse_config_roles(row[2]), row[3])
+        self.configs[config.guild_id] = config
+        return config
+
+
+    def fill(self, conn, guild_id):
+        """Load a single guild's configuration. Returns None if the guild has no row yet."""
+        rows = conn.execute("SELECT id, stat_mapping, config_roles, default_leaderboard FROM guilds WHERE id = ?", (guild_id,)).fetchall()
+        if rows:
+            return self._load_row(rows[0])
+        return None
+
+
+    def fill_all(self, conn):
+        """Load the configuration of every known guild."""
+        for row in conn.execute("SELECT id, stat_mapping, config_roles, default_leaderboard FROM guilds"):
+            self._load_row(row)
+        return len(self.configs)
+
+
+    def set_stat_mapping(self, guild_id, stat_mapping):
+        config = self.configs.get(guild_id)
+        if config is not None:
+            config.stat_mapping = stat_mapping
+            config.stat_index = StatIndex(stat_mapping)
+
+
+    def set_default_leaderboard(self, guild_id, default_leaderboard):
+        config = self.configs.get(guild_id)
+        if config is not None:
+            config.default_leaderboard = default_leaderboard
+
+
+    def invalidate(self, guild_id):
+        self.configs.pop(guild_id, None)
+
+
+    def stats(self):
+        return {'guilds': len(self.configs), 'hits': self.hits, 'misses': self.misses}
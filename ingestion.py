@@ -0,0 +1,194 @@
+"""Bounded queue decoupling gateway event handlers from their database and REST work"""
+
+import asyncio
+import os
+import time
+from json import loads, dumps
+from typing import NamedTuple
+
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'spill')
+
+
+class ChannelRef(NamedTuple):
+    """The parts of a channel that stat matching needs, see StatIndex.get."""
+    id: int
+    category_id: int
+
+
+class MessageRecord(NamedTuple):
+    guild_id: int
+    channel_id: int
+    category_id: int
+    user_id: int
+    emoji_ids: list
+
+
+class ReactionRecord(NamedTuple):
+    guild_id: int
+    emoji_id: int
+    added: bool
+
+
+RECORD_TYPES = {record_type.__name__: record_type for record_type in (MessageRecord, ReactionRecord)}
+
+
+def _serialize(record):
+    return dumps([type(record).__name__, *record]) + '\n'
+
+
+class IngestQueue:
+    """A bounded asyncio.Queue of event records consumed by a pool of worker tasks, each awaiting `handler(record)`.
+    When the queue is full, `put` either waits for room ('block'), discards the oldest queued record ('drop_oldest')
+    or appends the record to spill_path ('spill'). Spilled records are read back in order as the queue drains,
+    including after a restart."""
+    def __init__(self, maxsize=10000, policy='block', spill_path=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{policy}'. Expected one of {OVERFLOW_POLICIES}")
+        if policy == 'spill' and not spill_path:
+            raise ValueError("The 'spill' overflow policy requires a spill path")
+
+        self.handler = None
+        self.policy = policy
+        self.spill_path = spill_path
+        self.queue = asyncio.Queue(maxsize)
+        self.workers = []
+        self.interrupted = []
+        self.spill_offset = 0
+        self.spill_pending = 0
+        if spill_path and os.path.exists(spill_path):
+            with open(spill_path) as f:
+                self.spill_pending = sum(1 for _ in f)
+        self.enqueued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.busy_time = 0.0
+
+
+    def start(self, handler, workers):
+        self.handler = handler
+        for _ in range(workers):
+            self.workers.append(asyncio.create_task(self._work()))
+
+
+    async def stop(self, timeout=10):
+        """Give the workers up to timeout seconds to drain the queue, then cancel them. Spilled records stay on disk,
+        and with the 'spill' policy so do the records still queued."""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Stopped event ingestion with {self.queue.qsize()} records still queued.")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+        queued = []
+        if self.policy == 'spill':
+            # Records being processed or still queued, including ones already read back from the spill file,
+            # go back to its front
+            queued, self.interrupted = self.interrupted, []
+            while not self.queue.empty():
+                queued.append(self.queue.get_nowait())
+                self.queue.task_done()
+        if not queued and not (self.spill_pending and self.spill_offset):
+            return
+
+        # Drop the records already read back so they are not processed again on the next start
+        remaining = ''
+        if self.spill_pending:
+            with open(self.spill_path) as f:
+                f.seek(self.spill_offset)
+                remaining = f.read()
+        tmp_path = f"{self.spill_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.writelines(_serialize(record) for record in queued)
+            f.write(remaining)
+        os.replace(tmp_path, self.spill_path)
+        self.spill_pending += len(queued)
+        self.spill_offset = 0
+
+
+    async def put(self, record):
+        self.enqueued += 1
+        if self.policy == 'block':
+            await self.queue.put(record)
+        elif self.policy == 'drop_oldest':
+            if self.queue.full():
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+            self.queue.put_nowait(record)
+        elif self.spill_pending or self.queue.full():
+            # Once anything is spilled, later records are spilled too so they are processed in order
+            self._spill(record)
+        else:
+            self.queue.put_nowait(record)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+
+    def _spill(self, record):
+        with open(self.spill_path, 'a') as f:
+            f.write(_serialize(record))
+        self.spill_pending += 1
+        self.spilled += 1
+
+
+    def _refill(self):
+        """Move spilled records back into the queue while it is at most half full, or empty for a queue of one."""
+        room = max(1, self.queue.maxsize // 2) - self.queue.qsize()
+        if room <= 0 or not self.spill_pending:
+            return
+
+        with open(self.spill_path) as f:
+            f.seek(self.spill_offset)
+            while room > 0:
+                line = f.readline()
+                if not line:
+                    break
+                record_type, *fields = loads(line)
+                self.queue.put_nowait(RECORD_TYPES[record_type](*fields))
+                self.spill_pending -= 1
+                room -= 1
+            self.spill_offset = f.tell()
+
+        if not self.spill_pending:
+            os.remove(self.spill_path)
+            self.spill_offset = 0
+
+
+    async def _work(self):
+        while True:
+            if self.spill_pending:
+                self._refill()
+            record = await self.queue.get()
+            started = time.perf_counter()
+            try:
+                await self.handler(record)
+            except asyncio.CancelledError:
+                self.interrupted.append(record)
+                raise
+            except Exception as e:
+                self.errors += 1
+                print(f"Failed to process {type(record).__name__} {record}\n\tError - {e}")
+            finally:
+                self.busy_time += time.perf_counter() - started
+                self.processed += 1
+                self.queue.task_done()
+
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize(),
+            'max_depth': self.max_depth,
+            'spill_pending': self.spill_pending,
+            'enqueued': self.enqueued,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'errors': self.errors,
+            'busy_time': self.busy_time
+        }
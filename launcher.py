@@ -0,0 +1,199 @@
+"""Cluster launcher running LeaderboardsBot shards across several worker processes"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+from json import loads
+from os.path import join, dirname, abspath
+import database
+import migrations
+from config.env_vars import prod_vars, dev_vars
+
+
+MAIN_PATH = join(dirname(abspath(__file__)), "main.py")
+
+
+def split_shards(shard_count, workers):
+    """Split shard ids 0..shard_count-1 into at most `workers` contiguous, evenly sized groups."""
+    workers = min(workers, shard_count)
+    size, extra = divmod(shard_count, workers)
+    groups = []
+    start = 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(list(range(start, end)))
+        start = end
+    return groups
+
+
+class Worker:
+    """One bot process running a fixed group of shards. It is restarted with exponential backoff whenever it exits
+    or stops reporting health."""
+    def __init__(self, index, shard_ids, shard_count, db_path, health_dir, metrics_port=None):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.db_path = db_path
+        self.health_file = join(health_dir, f"worker-{index}.json")
+        self.metrics_port = metrics_port
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.failures = 0
+        self.next_start = 0.0
+
+
+    def start(self):
+        if os.path.exists(self.health_file):
+            os.remove(self.health_file)
+        env = dict(os.environ,
+                   LEADERBOARDS_BOT_SHARD_IDS=','.join(str(shard_id) for shard_id in self.shard_ids),
+                   LEADERBOARDS_BOT_SHARD_COUNT=str(self.shard_count),
+                   LEADERBOARDS_BOT_HEALTH_FILE=self.health_file)
+        if self.metrics_port:
+            env['LEADERBOARDS_BOT_METRICS_PORT'] = str(self.metrics_port)
+        self.process = subprocess.Popen([sys.executable, MAIN_PATH, self.db_path], env=env)
+        self.started = time.monotonic()
+        print(f"Started worker {self.index} (pid {self.process.pid}) with shards {self.shard_ids}")
+
+
+    def interrupt(self):
+        """Interrupt the worker so it flushes its buffered stats and closes cleanly."""
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+
+
+    def wait(self, timeout=30):
+        """Wait for an interrupted worker to exit, killing it after timeout seconds."""
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+    def stop(self, timeout=30):
+        self.interrupt()
+        self.wait(timeout)
+
+
+    def read_health(self):
+        try:
+            with open(self.health_file) as f:
+                return loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+
+    def schedule_restart(self, reason, min_uptime, backoff, max_backoff):
+        # A worker that stayed up for a while is not crash looping, restart it right away
+        if time.monotonic() - self.started >= min_uptime:
+            self.failures = 0
+        delay = min(max_backoff, backoff * 2 ** self.failures) if self.failures else 0
+        print(f"Worker {self.index} {reason}. Restarting in {delay:.0f}s")
+        self.failures += 1
+        self.restarts += 1
+        self.process = None
+        self.next_start = time.monotonic() + delay
+
+
+def report_health(workers):
+    healths = [(worker, worker.read_health()) for worker in workers]
+    guilds = sum(health['guilds'] for _, health in healths if health)
+    ready = sum(1 for worker, health in healths if worker.process is not None and health and health['ready'])
+    print(f"Cluster health: {ready}/{len(workers)} workers ready, {guilds} guilds, "
+          f"{sum(worker.restarts for worker in workers)} restarts")
+    for worker, health in healths:
+        if worker.process is None:
+            print(f"  worker {worker.index}: down, shards {worker.shard_ids}")
+        elif health is None:
+            print(f"  worker {worker.index}: starting, shards {worker.shard_ids}")
+        else:
+            latencies = ', '.join(f"{shard_id}: {latency * 1000:.0f}ms" for shard_id, latency in health['latencies'].items())
+            print(f"  worker {worker.index}: {'ready' if health['ready'] else 'connecting'}, {health['guilds']} guilds, "
+                  f"latencies {{{latencies}}}, pending stats {health['stat_buffer']['pending']}")
+
+
+def main():
+    run_env = os.getenv('LEADERBOARDS_BOT_RUN_ENVIRONMENT')
+    config_vars = prod_vars if run_env == 'prod' else dev_vars
+
+    parser = argparse.ArgumentParser(description="Run the bot's shards across several worker processes sharing one database.")
+    parser.add_argument('db_path', nargs='?', default=config_vars['DB_PATH'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument('--shards', type=int, default=None, help="Total shard count. Defaults to one shard per worker")
+    parser.add_argument('--health-dir', default=None, help="Directory for worker health files. Defaults to a folder next to the database")
+    parser.add_argument('--report-interval', type=float, default=60, help="Seconds between cluster health reports")
+    parser.add_argument('--stale-after', type=float, default=config_vars['HEALTH_REPORT_INTERVAL'] * 8,
+                        help="Restart a worker whose health report is older than this many seconds")
+    parser.add_argument('--startup-grace', type=float, default=300, help="Seconds a new worker may take to report health")
+    parser.add_argument('--backoff', type=float, default=5, help="Initial restart delay of a crash looping worker")
+    parser.add_argument('--max-backoff', type=float, default=300, help="Maximum restart delay")
+    parser.add_argument('--metrics-port', type=int, default=None, help="Serve worker i's metrics on this port + i")
+    args = parser.parse_args()
+
+    shard_count = args.shards or args.workers
+    health_dir = args.health_dir or join(dirname(abspath(args.db_path)), "health")
+    os.makedirs(health_dir, exist_ok=True)
+
+    # Migrate once up front so workers never race each other on schema changes
+    db = database.ConnectionManager(args.db_path, config_vars['DB_PRAGMAS'])
+    try:
+        migrations.migrate(db.acquire(), config_vars['MIGRATION_BATCH_SIZE'])
+    finally:
+        db.close()
+
+    workers = [Worker(i, shard_ids, shard_count, args.db_path, health_dir, args.metrics_port + i if args.metrics_port else None)
+               for i, shard_ids in enumerate(split_shards(shard_count, args.workers))]
+    stopping = False
+
+    def _stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    last_report = time.monotonic()
+    try:
+        while not stopping:
+            now = time.monotonic()
+            for worker in workers:
+                if worker.process is None:
+                    if now >= worker.next_start:
+                        worker.start()
+                    continue
+
+                exit_code = worker.process.poll()
+                if exit_code is not None:
+                    worker.schedule_restart(f"exited with code {exit_code}", args.startup_grace, args.backoff, args.max_backoff)
+                    continue
+
+                health = worker.read_health()
+                if health is None:
+                    stale = now - worker.started > args.startup_grace
+                else:
+                    stale = time.time() - health['timestamp'] > args.stale_after
+                if stale:
+                    worker.stop()
+                    worker.schedule_restart("stopped reporting health", args.startup_grace, args.backoff, args.max_backoff)
+
+            if now - last_report >= args.report_interval:
+                report_health(workers)
+                last_report = now
+            time.sleep(1)
+    finally:
+        print("Stopping workers...")
+        for worker in workers:
+            worker.interrupt()
+        for worker in workers:
+            worker.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""In-memory top-N leaderboards maintained incrementally"""
+
+
+class TopN:
+    """The highest `size` values of one stat in one guild, plus enough bookkeeping to know when they can no longer be trusted.
+
+    Users outside the board were at most `outside_max` when it was built. Their increments since then are counted in
+    `outside_increments`, so no outside user can exceed outside_max + the largest of those counts. As long as that bound
+    does not pass the lowest value shown, the board is exact. When every user of the guild fits on the board it is
+    `complete` and outside users are known exactly, so they can be promoted onto it."""
+    def __init__(self, rows, size, max_outside):
+        self.size = size
+        self.max_outside = max_outside
+        self.values = dict(rows[:size])
+        self.complete = len(rows) <= size
+        self.outside_max = 0 if self.complete else rows[size][1]
+        self.outside_increments = {}
+        self.outside_bump = 0
+        self.dirty = False
+
+
+    def increment(self, user_id, amount):
+        if user_id in self.values:
+            self.values[user_id] += amount
+            return
+
+        increments = self.outside_increments.get(user_id, 0) + amount
+        if self.complete:
+            self.values[user_id] = increments
+            self.outside_increments.pop(user_id, None)
+            if len(self.values) > self.size:
+                evicted = min(self.values, key=self.values.get)
+                self.outside_max = self.values.pop(evicted)
+                self.complete = False
+            return
+
+        self.outside_increments[user_id] = increments
+        self.outside_bump = max(self.outside_bump, increments)
+        if len(self.outside_increments) > self.max_outside:
+            self.dirty = True
+
+
+    def top(self, limit):
+        """Return the top `limit` (user_id, value) pairs, or None if they cannot be answered exactly without a rebuild."""
+        if self.dirty:
+            return None
+
+        rows = sorted(self.values.items(), key=lambda row: row[1], reverse=True)[:limit]
+        if not self.complete:
+            if len(rows) < limit or self.outside_max + self.outside_bump > rows[-1][1]:
+                return None
+        return rows
+
+
+class LeaderboardCache:
+    """TopN boards keyed by (guild_id, stat_id). Boards are built from the database on first use and after being
+    invalidated, and are kept current by every stat increment."""
+    def __init__(self, size=25, max_outside=1000):
+        self.size = size
+        self.max_outside = max_outside
+        self.boards = {}
+        self.hits = 0
+        self.rebuilds = 0
+
+
+    def increment(self, guild_id, stat_id, user_id, amount=1):
+        board = self.boards.get((guild_id, stat_id))
+        if board is not None:
+            board.increment(user_id, amount)
+
+
+    def top(self, guild_id, stat_id, limit):
+        board = self.boards.get((guild_id, stat_id))
+        if board is None:
+            return None
+
+        rows = board.top(limit)
+        if rows is not None:
+            self.hits += 1
+        return rows
+
+
+    def rebuild(self, guild_id, stat_id, rows):
+        """Replace the board from database rows sorted by value descending. Pass at least size + 1 rows when available."""
+        self.boards[(guild_id, stat_id)] = TopN(rows, self.size, self.max_outside)
+        self.rebuilds += 1
+
+
+    def invalidate(self, guild_id, stat_id=None):
+        if stat_id is not None:
+            self.boards.pop((guild_id, stat_id), None)
+        else:
+            for key in [key for key in self.boards if key[0] == guild_id]:
+                del self.boards[key]
+
+
+    def stats(self):
+        return {'boards': len(self.boards), 'hits': self.hits, 'rebuilds': self.rebuilds}
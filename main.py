@@ -3,44 +3,118 @@
 """
 TODO:
 - Add a app_commands.check function to check for administrator or configured roles to handle permissions, rather than use defaults.
-- Create a proper database migration tool
 - Admin command to remove deleted emojis from the emoji leaderboard. Just delete them from database entirely if they aren't found.
 """
 
 import os
 from random import randint
-from json import loads, dumps
+from json import dumps
+from hashlib import sha256
+from copy import deepcopy
+from functools import wraps
 from typing import Optional
 import re
 import asyncio
 import sqlite3
 import datetime
 import sys
+import time
 import discord
 from discord import app_commands
+import backfill
+import database
+import emoji_registry
+import guild_config
+import ingestion
+import leaderboards
 import menu
+import metrics
+import migrations
+import profiling
 import modal
+import render_cache
+import rest
+import rollups
+import slow_mode
+import stat_buffer
+import stat_index as stat_index_module
+import tracing
+import user_names
 from config.env_vars import prod_vars, dev_vars
 
 
 synced_guilds = set()
-async def sync_commands_to_guild(clientObj, guild_id):
-    try:
-        if guild_id in synced_guilds:
-            return
+async def sync_commands_to_guild(clientObj, guild_id, retries=0):
+    """Sync the global commands to the guild, retrying failures with backoff. Returns whether the guild is synced."""
+    if guild_id in synced_guilds:
+        return True
+
+    guild = discord.Object(id=guild_id)
+    clientObj.tree.copy_global_to(guild=guild)
+    for attempt in range(retries + 1):
+        try:
+            with metrics.timer('rest', 'tree.sync'):
+                # Syncs are already bounded by COMMAND_SYNC_CONCURRENCY, so they do not take a REST_BACKGROUND_CONCURRENCY slot
+                await clientObj.rest.call(('tree.sync', guild_id), lambda: clientObj.tree.sync(guild=guild), rest.BACKGROUND, limited=False)
+            synced_guilds.add(guild_id)
+            return True
+        except discord.Forbidden as e:
+            print(f"Not allowed to sync commands for guild id {guild_id}. Error: {e}")
+            return False
+        except Exception as e:
+            if attempt == retries:
+                print(f"Failed to sync commands for guild id {guild_id}. Error: {e}")
+                return False
+            await asyncio.sleep(clientObj.command_sync_backoff * 2 ** attempt)
+
+
+def get_command_tree_hash(tree: app_commands.CommandTree):
+    """Fingerprint of the global commands, equal for guilds that already have them."""
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda command: command['name'])
+    return sha256(dumps(payload, sort_keys=True).encode()).hexdigest()
 
-        guild = discord.Object(id=guild_id)
-        clientObj.tree.copy_global_to(guild=guild)
-        await clientObj.tree.sync(guild=guild)
-        synced_guilds.add(guild_id)
+
+@metrics.timed('db')
+def save_command_tree_hash(guild_ids, commands_hash):
+    conn = create_connection()
+    try:
+        conn.executemany("UPDATE guilds SET commands_hash = ? WHERE id = ?", [(commands_hash, guild_id) for guild_id in guild_ids])
+        conn.commit()
     except Exception as e:
-        print(f"Failed to sync commands for guild id {guild_id}. Error: {e}")
+        print(f"Failed to save command tree hash. Error: {e}")
+    finally:
+        release_connection(conn)
+
+
+async def sync_commands_to_guilds(clientObj, rows):
+    """Sync the global commands to the guilds whose stored hash differs from the current command tree."""
+    started = time.perf_counter()
+    to_sync = []
+    for guild_id, commands_hash in rows:
+        if commands_hash == clientObj.command_tree_hash:
+            synced_guilds.add(guild_id)
+        else:
+            to_sync.append(guild_id)
+
+    semaphore = asyncio.Semaphore(clientObj.command_sync_concurrency)
+
+    async def _sync(guild_id):
+        async with semaphore:
+            return await sync_commands_to_guild(clientObj, guild_id, clientObj.command_sync_retries)
+
+    results = await asyncio.gather(*(_sync(guild_id) for guild_id in to_sync))
+    synced = [guild_id for guild_id, result in zip(to_sync, results) if result]
+    if synced:
+        save_command_tree_hash(synced, clientObj.command_tree_hash)
+
+    print(f"Command sync: {len(rows) - len(to_sync)} unchanged, {len(synced)} synced, {len(to_sync) - len(synced)} failed "
+          f"in {time.perf_counter() - started:.1f}s")
 
 
 def create_connection():
     conn = None
     try:
-        conn = sqlite3.connect(client.db_path)
+        conn = client.db.acquire()
         return conn
     except sqlite3.Error as e:
         print(e)
@@ -48,6 +122,13 @@ def create_connection():
     return conn
 
 
+def release_connection(conn):
+    try:
+        client.db.release(conn)
+    except sqlite3.Error as e:
+        print(e)
+
+
 def cleanse_string(string):
     bad_string = False
     i = 0
@@ -60,30 +141,226 @@ def cleanse_string(string):
     return "".join(char for char in string if char.isalnum() or char == '_'), bad_string
 
 
-class LeaderboardsBot(discord.Client):
+class LeaderboardsTree(app_commands.CommandTree):
+    """Command tree that profiles and times its commands and runs them as interactive REST work"""
+    def command(self, **kwargs):
+        decorator = super().command(**kwargs)
+        name = kwargs.get('name')
+
+        def wrapper(func):
+            @wraps(func)
+            async def interactive(*args, **kwargs):
+                async with self.client.rest.interactive():
+                    return await func(*args, **kwargs)
+            return decorator(profiling.profiled('command', name)(metrics.timed('command', name)(interactive)))
+        return wrapper
+
+
+class LeaderboardsBot(discord.AutoShardedClient):
     """Class to handle the discord client object"""
     def __init__(self, config_settings, **options):
         self.db_path = config_settings['DB_PATH']
         self.bot_color = config_settings['BOT_COLOR']
         self.max_stats_per_guild = config_settings['MAX_STATS_PER_GUILD']
-        super().__init__(intents = config_settings['INTENTS'], **options)
-        self.tree = app_commands.CommandTree(self)
+        self.stat_purge_batch_size = config_settings['STAT_PURGE_BATCH_SIZE']
+        self.migration_batch_size = config_settings['MIGRATION_BATCH_SIZE']
+        self.db = database.ConnectionManager(self.db_path, config_settings['DB_PRAGMAS'])
+        self.stat_buffer = stat_buffer.StatBuffer(config_settings['STAT_FLUSH_MAX_PENDING'], config_settings['STAT_FLUSH_MAX_STALENESS'])
+        self.stat_flush_task = None
+        self.guild_configs = guild_config.GuildConfigCache()
+        self.emoji_registry = emoji_registry.EmojiRegistry()
+        self.leaderboards = leaderboards.LeaderboardCache(config_settings['LEADERBOARD_CACHE_SIZE'])
+        self.username_cache = user_names.UserNameCache(config_settings['USER_NAME_CACHE_SIZE'], config_settings['USER_NAME_CACHE_TTL'])
+        self.renders = render_cache.RenderCache(config_settings['RENDER_CACHE_SIZE'], config_settings['RENDER_CACHE_FRESHNESS'],
+                                                config_settings['RENDER_CACHE_MAX_AGE'])
+        self.user_fetch_semaphore = asyncio.Semaphore(config_settings['USER_FETCH_CONCURRENCY'])
+        self.rest = rest.RestScheduler(config_settings['REST_BACKGROUND_CONCURRENCY'], config_settings['REST_BACKGROUND_MAX_WAIT'])
+        self.history_concurrency = config_settings['HISTORY_CONCURRENCY']
+        self.history_progress_interval = config_settings['HISTORY_PROGRESS_INTERVAL']
+        self.backfill_checkpoint_messages = config_settings['BACKFILL_CHECKPOINT_MESSAGES']
+        self.backfill_spill_users = config_settings['BACKFILL_SPILL_USERS']
+        self.backfill_tasks = {}
+        self.backfill_progress = {}
+        self.tasks = set()
+        self.rollup_keep_hours = config_settings['ROLLUP_HOURLY_RETENTION_HOURS']
+        self.rollup_keep_days = config_settings['ROLLUP_DAILY_RETENTION_DAYS']
+        self.rollup_compact_interval = config_settings['ROLLUP_COMPACT_INTERVAL']
+        self.rollup_compact_task = None
+        self.slow_mode = slow_mode.SlowModeTracker()
+        self.command_sync_concurrency = config_settings['COMMAND_SYNC_CONCURRENCY']
+        self.command_sync_retries = config_settings['COMMAND_SYNC_RETRIES']
+        self.command_sync_backoff = config_settings['COMMAND_SYNC_BACKOFF']
+        self.command_tree_hash = None
+        self.health_file = config_settings['HEALTH_FILE']
+        self.health_report_interval = config_settings['HEALTH_REPORT_INTERVAL']
+        self.health_task = None
+        self.started = time.time()
+        self.ingest_queue = ingestion.IngestQueue(config_settings['INGEST_QUEUE_SIZE'], config_settings['INGEST_OVERFLOW_POLICY'],
+                                                  config_settings['INGEST_SPILL_PATH'])
+        self.ingest_workers = config_settings['INGEST_WORKERS']
+        self.trace = None
+        if config_settings['TRACE_FILE']:
+            self.trace = tracing.TraceRecorder(config_settings['TRACE_FILE'], config_settings['TRACE_ANONYMIZE'], os.getenv('LEADERBOARDS_BOT_TRACE_SALT'))
+        super().__init__(intents = config_settings['INTENTS'], shard_ids = config_settings['SHARD_IDS'],
+                         shard_count = config_settings['SHARD_COUNT'], **options)
+        self.tree = LeaderboardsTree(self)
 
 
     async def setup_hook(self):
+        rest.watch_rate_limits(self.rest)
+        self.stat_flush_task = asyncio.create_task(self.flush_stats_periodically())
+        self.ingest_queue.start(process_ingested_event, self.ingest_workers)
+
+        conn = create_connection()
+        try:
+            migrations.migrate(conn, self.migration_batch_size)
+            print(f"Database schema version: {migrations.get_version(conn)}")
+        except Exception as e:
+            print(f"Error migrating database schema. Error: {e}")
+        finally:
+            release_connection(conn)
+        self.spawn(resume_backfill_jobs())
+        # Rollups are shared by all workers of a cluster, only the worker running shard 0 compacts them
+        if self.shard_ids is None or 0 in self.shard_ids:
+            self.rollup_compact_task = asyncio.create_task(self.compact_rollups_periodically())
+        if self.health_file:
+            self.health_task = asyncio.create_task(self.report_health_periodically())
+        if metrics.PORT:
+            await self.start_metrics()
+
+        conn = create_connection()
+        try:
+            self.guild_configs.fill_all(conn)
+        except Exception as e:
+            print(f"Error loading guild configs. Error: {e}")
+        finally:
+            release_connection(conn)
+
         # Copy the global commands to guilds we are aware of already on startup
+        self.command_tree_hash = get_command_tree_hash(self.tree)
         conn = create_connection()
         cur = conn.cursor()
         try:
-            cur.execute("SELECT id FROM guilds")
-            rows = cur.fetchall()
-            if rows:
-                for row in rows:
-                    await sync_commands_to_guild(self, row[0])
+            cur.execute("SELECT id, commands_hash FROM guilds")
+            rows = [row for row in cur.fetchall() if self.owns_guild(row[0])]
         except Exception as e:
             print(f"Error syncing command tree to existing guilds. Error: {e}")
+            rows = []
         finally:
-            conn.close()
+            release_connection(conn)
+        await sync_commands_to_guilds(self, rows)
+
+
+    def event(self, coro):
+        # Profile every event handler registered with @client.event
+        return super().event(profiling.profiled('event')(coro))
+
+
+    def spawn(self, coro):
+        """Start a task that is referenced until it finishes."""
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+
+    def owns_guild(self, guild_id):
+        if self.shard_ids is None:
+            return True
+        return (guild_id >> 22) % self.shard_count in self.shard_ids
+
+
+    async def start_metrics(self):
+        registry = metrics.REGISTRY
+        registry.gauge('leaderboards_ingest_queue_depth', lambda: self.ingest_queue.queue.qsize())
+        registry.gauge('leaderboards_ingest_spill_pending', lambda: self.ingest_queue.spill_pending)
+        registry.counter('leaderboards_ingest_dropped_total', lambda: self.ingest_queue.dropped)
+        registry.gauge('leaderboards_stat_buffer_pending', lambda: len(self.stat_buffer.pending))
+        registry.gauge('leaderboards_leaderboard_cache_boards', lambda: len(self.leaderboards.boards))
+        registry.gauge('leaderboards_username_cache_size', lambda: len(self.username_cache.entries))
+        registry.gauge('leaderboards_render_cache_size', lambda: len(self.renders.entries))
+        registry.counter('leaderboards_render_cache_hits_total', lambda: self.renders.hits)
+        registry.counter('leaderboards_db_ops_total', lambda: self.db.ops)
+        registry.gauge('leaderboards_rest_inflight', lambda: len(self.rest.inflight))
+        registry.gauge('leaderboards_rest_background_waiting', lambda: self.rest.background_waiting)
+        registry.gauge('leaderboards_guilds', lambda: len(self.guilds))
+        try:
+            await metrics.serve()
+        except OSError as e:
+            print(f"Failed to start metrics endpoint. Error: {e}")
+
+
+    def health(self):
+        return {
+            'pid': os.getpid(),
+            'shard_ids': self.shard_ids,
+            'shard_count': self.shard_count,
+            'ready': self.is_ready(),
+            'guilds': len(self.guilds),
+            'latencies': dict(self.latencies),
+            'uptime': time.time() - self.started,
+            'timestamp': time.time(),
+            'stat_buffer': self.stat_buffer.stats(),
+            'ingest': self.ingest_queue.stats(),
+            'leaderboards': self.leaderboards.stats(),
+            'renders': self.renders.stats(),
+            'rest': self.rest.stats(),
+            'db': self.db.stats()
+        }
+
+
+    async def report_health_periodically(self):
+        while True:
+            try:
+                tmp_file = f"{self.health_file}.tmp"
+                with open(tmp_file, 'w') as f:
+                    f.write(dumps(self.health()))
+                os.replace(tmp_file, self.health_file)
+            except Exception as e:
+                print(f"Failed to write health report. Error: {e}")
+            await asyncio.sleep(self.health_report_interval)
+
+
+    async def flush_stats_periodically(self):
+        while True:
+            await asyncio.sleep(self.stat_buffer.max_staleness)
+            if self.stat_buffer.should_flush():
+                flush_user_stats()
+            if self.trace is not None:
+                self.trace.flush()
+
+
+    async def compact_rollups_periodically(self):
+        while True:
+            conn = create_connection()
+            try:
+                rows = rollups.compact(conn, self.rollup_keep_hours, self.rollup_keep_days, self.stat_purge_batch_size)
+                if rows:
+                    print(f"Compacted {rows} stat rollup rows.")
+            except Exception as e:
+                print(f"Failed to compact stat rollups. Error: {e}")
+            finally:
+                release_connection(conn)
+            await asyncio.sleep(self.rollup_compact_interval)
+
+
+    async def close(self):
+        if self.stat_flush_task is not None:
+            self.stat_flush_task.cancel()
+        if self.rollup_compact_task is not None:
+            self.rollup_compact_task.cancel()
+        if self.health_task is not None:
+            self.health_task.cancel()
+        for task in list(self.tasks):
+            task.cancel()
+        await self.ingest_queue.stop()
+        flush_user_stats()
+        if self.trace is not None:
+            self.trace.close()
+            print(f"Recorded {self.trace.events} events to {self.trace.path}")
+        await super().close()
+        print(f"Database connection stats: {self.db.stats()}")
+        self.db.close()
 
 
 run_env = os.getenv('LEADERBOARDS_BOT_RUN_ENVIRONMENT')
@@ -94,56 +371,88 @@ else:
 
 if len(sys.argv) > 1:
     config_vars['DB_PATH'] = sys.argv[1]
+
+# Set by launcher.py for each worker process of a cluster
+shard_ids = os.getenv('LEADERBOARDS_BOT_SHARD_IDS')
+if shard_ids:
+    config_vars['SHARD_IDS'] = [int(shard_id) for shard_id in shard_ids.split(',')]
+    config_vars['SHARD_COUNT'] = int(os.getenv('LEADERBOARDS_BOT_SHARD_COUNT'))
+    # Workers must not share a spill file
+    config_vars['INGEST_SPILL_PATH'] = f"{config_vars['INGEST_SPILL_PATH']}.{config_vars['SHARD_IDS'][0]}"
+if os.getenv('LEADERBOARDS_BOT_HEALTH_FILE'):
+    config_vars['HEALTH_FILE'] = os.getenv('LEADERBOARDS_BOT_HEALTH_FILE')
+
+# Record handled events for benchmarks/replay.py, one trace file per worker of a cluster
+trace_file = os.getenv('LEADERBOARDS_BOT_TRACE_FILE')
+if trace_file:
+    if config_vars['SHARD_IDS']:
+        root, ext = os.path.splitext(trace_file[:-3] if trace_file.endswith('.gz') else trace_file)
+        trace_file = f"{root}.{config_vars['SHARD_IDS'][0]}{ext}{'.gz' if trace_file.endswith('.gz') else ''}"
+    config_vars['TRACE_FILE'] = trace_file
+    config_vars['TRACE_ANONYMIZE'] = os.getenv('LEADERBOARDS_BOT_TRACE_ANONYMIZE') == '1'
+
 client = LeaderboardsBot(config_vars)
 
 
-def get_stat_col(channel, stat_mapping, stat_type, **kwargs):
-    stat_cols = []
-    for stat in stat_mapping['Mapping']:
-        if stat['Type'] == stat_type and \
-                (  # Logical block for matching the scope of the stat
-                    (stat['Level'] == "Guild" and 'CategoryOnly' not in kwargs and 'ChannelOnly' not in kwargs) or
-                    (stat['Level'] == 'Category' and channel.category_id == stat['LevelID'] and 'GuildOnly' not in kwargs and 'ChannelOnly' not in kwargs) or
-                    (stat['Level'] == 'Channel' and channel.id == stat['LevelID'] and 'GuildOnly' not in kwargs and 'CategoryOnly' not in kwargs)
-                ) \
-                and \
-                (  # Logical block for matching specifics of the stat type
-                    (stat['Type'] == "Dice" and stat['DiceType'] == kwargs['DiceType'] and stat['Target'] == kwargs['DiceResult']) or
-                    (stat['Type'] == 'total_messages')
-                ):
-            stat_cols.append(stat['StatCol'])
-
-    return stat_cols
-
-
-def update_user_stat(user_id, guild_id, stat_col, value):
+def get_stat_col(channel, stat_index, stat_type, **kwargs):
+    # Scope of the stat to match
+    if 'GuildOnly' in kwargs:
+        levels = ('Guild',)
+    elif 'CategoryOnly' in kwargs:
+        levels = ('Category',)
+    elif 'ChannelOnly' in kwargs:
+        levels = ('Channel',)
+    else:
+        levels = stat_index_module.ALL_LEVELS
+
+    return stat_index.get(channel, stat_type, levels, kwargs.get('DiceType'), kwargs.get('DiceResult'))
+
+
+@metrics.timed('db')
+def flush_user_stats():
+    conn = create_connection()
+    try:
+        client.stat_buffer.flush(conn)
+    except Exception as e:
+        print(f"Failed to flush buffered user stats. Pending: {len(client.stat_buffer.pending)}\n\tError - {e}")
+    finally:
+        release_connection(conn)
+
+
+@metrics.timed('db')
+def update_user_stat(user_id, guild_id, stat_id, value):
+    if value == 'increment':
+        # Increments are buffered and written in batches, see StatBuffer
+        client.stat_buffer.add(guild_id, user_id, stat_id)
+        client.leaderboards.increment(guild_id, stat_id, user_id)
+        client.renders.bump(guild_id, stat_id)
+        if client.stat_buffer.should_flush():
+            flush_user_stats()
+        return
+
+    # Absolute values must not be overtaken by older buffered increments
+    flush_user_stats()
+    client.leaderboards.invalidate(guild_id, stat_id)
+    client.renders.invalidate(guild_id, stat_id)
     conn = create_connection()
     cur = conn.cursor()
 
     try:
-        if value == 'increment':
-            sql = f"""  INSERT INTO guilds_users(guild_id, user_id, {stat_col}) VALUES(?,?,1)
-                        ON CONFLICT(guild_id, user_id) DO UPDATE 
-                        SET {stat_col} = {stat_col} + 1
-                        WHERE guild_id = ? AND user_id = ?
-                    """
-            params = (guild_id, user_id, guild_id, user_id)
-        else:
-            sql = f"""  INSERT INTO guilds_users(guild_id, user_id, {stat_col}) VALUES(?,?,?)
-                        ON CONFLICT(guild_id, user_id) DO UPDATE 
-                        SET {stat_col} = ?
-                        WHERE guild_id = ? AND user_id = ?
-                    """
-            params = (guild_id, user_id, value, value, guild_id, user_id)
+        sql = """   INSERT INTO user_stats(guild_id, stat_id, user_id, value) VALUES(?,?,?,?)
+                    ON CONFLICT(guild_id, stat_id, user_id) DO UPDATE 
+                    SET value = excluded.value
+                """
+        params = (guild_id, stat_id, user_id, value)
 
         cur.execute(sql, params)
         conn.commit()
     except Exception as e:
-        print(f"Failed to update {stat_col} for guild: {guild_id} and user {user_id}\n\tError - {e}")
+        print(f"Failed to update stat {stat_id} for guild: {guild_id} and user {user_id}\n\tError - {e}")
     finally:
-        conn.close()
+        release_connection(conn)
 
 
+@metrics.timed('db')
 def update_emote_count(guild_id, emote_id, increment):
     """Update the usage counter for an emote. Set increment True to increment, False to decrement."""
     conn = create_connection()
@@ -161,13 +470,14 @@ def update_emote_count(guild_id, emote_id, increment):
     except Exception as e:
         print(f"Failed to update emote count for guild: {guild_id} and emote {emote_id}\n\tError - {e}")
     finally:
-        conn.close()
+        release_connection(conn)
 
 
 def get_basic_embed(msg):
     return discord.Embed(color=client.bot_color, description=msg)
 
 
+@metrics.timed('rest')
 async def reply(interaction: discord.Interaction, msg: str, title: str = None, ephemeral: bool = False, view: discord.ui.View = discord.utils.MISSING):
     embed_msg = get_basic_embed(msg)
     if title is not None:
@@ -179,6 +489,7 @@ async def reply(interaction: discord.Interaction, msg: str, title: str = None, e
         await interaction.response.send_message(embed=embed_msg, ephemeral=ephemeral, view=view)
 
 
+@metrics.timed('rest')
 async def send_final_message(interaction: discord.Interaction, msg: str, title: str = None, view: discord.ui.View = discord.utils.MISSING):
     embed_msg = get_basic_embed(msg)
     if title is not None:
@@ -201,20 +512,31 @@ async def run_select_menu(interaction: discord.Interaction, menu_options: list[m
     await reply(interaction, None, title=title, view=view, ephemeral=ephemeral)
 
 
+def get_guild_config(guild_id):
+    """Return the cached GuildConfig for the guild, loading it on a cache miss."""
+    with metrics.timer('cache', 'guild_configs'):
+        config = client.guild_configs.get(guild_id)
+    if config is not None:
+        return config
+
+    conn = create_connection()
+    try:
+        return client.guild_configs.fill(conn, guild_id)
+    except Exception as e:
+        print(f"Error loading config for guild with id: {guild_id}\n\t Error: {e}")
+    finally:
+        release_connection(conn)
+
+
 def on_message_retrieve_guild_data(guild_id, retry=False):
+    config = get_guild_config(guild_id)
+    if config is not None:
+        return config
+
     conn = create_connection()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT stat_mapping, config_roles FROM guilds WHERE id = ?", (guild_id,))
-        rows = cur.fetchall()
-        if rows:
-            config_roles = rows[0][1]
-            if not config_roles:
-                config_roles = []
-            else:
-                config_roles = [int(v) for v in config_roles.split(',')]
-            return loads(rows[0][0]), config_roles
-        elif not retry:
+        if not retry:
             cur.execute("INSERT INTO guilds(id) VALUES (?)", (guild_id,))
             conn.commit()
             return on_message_retrieve_guild_data(guild_id, retry=True)
@@ -223,21 +545,25 @@ def on_message_retrieve_guild_data(guild_id, retry=False):
     except Exception as e:
         print(f"Error retrieving guild data for guild id: {guild_id}\n\t Error: {e}")
     finally:
-        conn.close()
+        release_connection(conn)
 
 
 def get_stat_mapping(guild_id):
-    conn = create_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute("SELECT stat_mapping FROM guilds WHERE id = ?", (guild_id,))
-        rows = cur.fetchall()
-        if rows:
-            return loads(rows[0][0])
-    except Exception as e:
-        print(f"Error getting stat mapping from guild with id: {guild_id}\n\t Error: {e}")
-    finally:
-        conn.close()
+    """The returned mapping is shared with the config cache, deepcopy it before mutating."""
+    config = get_guild_config(guild_id)
+    if config is not None:
+        return config.stat_mapping
+
+
+@metrics.timed('rest')
+async def read_slow_mode_activity(channel, delay, now: datetime.datetime):
+    activity = []
+    async for message in channel.history(after=now - datetime.timedelta(seconds=delay), oldest_first=False):
+        activity.append((message.author.id, message.created_at.timestamp()))
+        # Message is a result of a user's former interaction (but not an ephemeral interaction)
+        if message.interaction is not None and not message.flags.ephemeral:
+            activity.append((message.interaction.user.id, message.created_at.timestamp()))
+    return activity
 
 
 async def verify_slow_mode(interaction: discord.Interaction) -> bool:
@@ -246,50 +572,115 @@ async def verify_slow_mode(interaction: discord.Interaction) -> bool:
         return True
 
     now = datetime.datetime.now(datetime.UTC)
-    delay_delta = datetime.timedelta(seconds=delay)
-    cutoff_time = now - delay_delta
-    async for message in interaction.channel.history(after=cutoff_time, oldest_first=False):
-        # If message is by the current user, or message is a result of the user's former interaction (but not an ephemeral interaction)
-        if message.author.id == interaction.user.id or (message.interaction.user.id == interaction.user.id and not message.flags.ephemeral):
-            time_since_message_was_sent = now - message.created_at
-            remaining_cd = delay_delta - time_since_message_was_sent
-            hours, remainder = divmod(remaining_cd.seconds, 3600)
-            minutes, seconds = divmod(remainder, 60)
-            await reply(interaction, "Must wait for slowmode cooldown. Remaining time: {:02}:{:02}:{:02}".format(int(hours), int(minutes), int(seconds)), ephemeral=True)
-            interaction.extras['failed'] = True
-            return False
+    remaining = client.slow_mode.remaining(interaction.channel.id, interaction.user.id, delay, now.timestamp())
+    if remaining is None:
+        # Activity from before the tracker started is unknown, read it from the channel once
+        activity = await read_slow_mode_activity(interaction.channel, delay, now)
+        client.slow_mode.warm(interaction.channel.id, delay, activity, now.timestamp())
+        remaining = client.slow_mode.remaining(interaction.channel.id, interaction.user.id, delay, now.timestamp())
+
+    if remaining:
+        hours, remainder = divmod(int(remaining), 3600)
+        minutes, seconds = divmod(remainder, 60)
+        await reply(interaction, "Must wait for slowmode cooldown. Remaining time: {:02}:{:02}:{:02}".format(int(hours), int(minutes), int(seconds)), ephemeral=True)
+        interaction.extras['failed'] = True
+        return False
 
     return True
 
 
+async def get_guild_emoji_name(guild: discord.Guild, emoji_id: int):
+    """Return the name of the guild's custom emoji, or None if the guild has no such emoji."""
+    registry = client.emoji_registry
+    if not registry.is_seeded(guild.id):
+        registry.seed(guild.id, guild.emojis)
+
+    name = registry.get_name(guild.id, emoji_id)
+    if name is not None or registry.is_missing(guild.id, emoji_id):
+        return name
+
+    try:
+        with metrics.timer('rest', 'fetch_emoji'):
+            emoji = await client.rest.call(('fetch_emoji', guild.id, emoji_id), lambda: guild.fetch_emoji(emoji_id))
+        registry.add(guild.id, emoji.id, emoji.name)
+        return emoji.name
+    except discord.errors.NotFound:
+        registry.mark_missing(guild.id, emoji_id)
+        return None
+
+
+@client.event
+@metrics.timed('event')
+async def on_guild_emojis_update(guild: discord.Guild, before, after):
+    client.emoji_registry.seed(guild.id, after)
+
+
+@client.event
+@metrics.timed('event')
+async def on_guild_remove(guild: discord.Guild):
+    client.emoji_registry.remove_guild(guild.id)
+
+
 @client.event
+@metrics.timed('event')
+async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    # Stat descriptions show channel and category names
+    if before.name != after.name:
+        client.renders.invalidate(after.guild.id)
+
+
+@client.event
+@metrics.timed('event')
 async def on_message(message: discord.Message):
     if message.author.id == client.user.id:
         return
 
-    stat_mapping, _ = on_message_retrieve_guild_data(message.guild.id)
-    if stat_mapping:
-        stat_cols = get_stat_col(message.channel, stat_mapping, "total_messages")
-        if stat_cols:
-            for col in stat_cols:
-                update_user_stat(message.author.id, message.guild.id, col, "increment")
+    client.slow_mode.record(message.channel.id, message.author.id, message.channel.slowmode_delay, message.created_at.timestamp())
 
     # Track any emojis in the message. Count only once evne if multiple occurences exist.
-    custom_emojis = set(re.findall(r'<:\w*:\d*>', message.content))
-    custom_emojis_ids = [e.split(':')[-1].replace('>', '') for e in custom_emojis]
-    for emoji_id in custom_emojis_ids:
+    emoji_ids = emoji_registry.parse_custom_emoji_ids(message.content)
+
+    if client.trace is not None:
+        client.trace.message(message.guild.id, message.channel.id, message.channel.category_id, message.author.id,
+                             message.channel.slowmode_delay, emoji_ids)
+
+    # Database and REST work is done by the ingestion workers, see process_ingested_event
+    await client.ingest_queue.put(ingestion.MessageRecord(message.guild.id, message.channel.id, message.channel.category_id,
+                                                          message.author.id, emoji_ids))
+
+
+async def process_message_record(record: ingestion.MessageRecord):
+    config = on_message_retrieve_guild_data(record.guild_id)
+    if config:
+        stat_ids = get_stat_col(ingestion.ChannelRef(record.channel_id, record.category_id), config.stat_index, "total_messages")
+        if stat_ids:
+            for stat_id in stat_ids:
+                update_user_stat(record.user_id, record.guild_id, stat_id, "increment")
+
+    guild = client.get_guild(record.guild_id)
+    for emoji_id in record.emoji_ids:
         # Verify real emoji and not injection before saving to db
-        try:
-            await message.guild.fetch_emoji(emoji_id)
-            update_emote_count(message.guild.id, emoji_id, True)
-        except discord.errors.NotFound:
+        if guild is not None and await get_guild_emoji_name(guild, emoji_id) is not None:
+            update_emote_count(record.guild_id, emoji_id, True)
+        else:
             print("Failed to update count for emoji not found in the guild.")
 
     # Attempt to sync commands to the guild if necessary. Guild may not have been in database on startup
-    await sync_commands_to_guild(client, message.guild.id)
+    if record.guild_id not in synced_guilds and await sync_commands_to_guild(client, record.guild_id):
+        save_command_tree_hash([record.guild_id], client.command_tree_hash)
+
+
+@profiling.profiled('event')
+@metrics.timed('event')
+async def process_ingested_event(record):
+    if isinstance(record, ingestion.MessageRecord):
+        await process_message_record(record)
+    elif isinstance(record, ingestion.ReactionRecord):
+        update_emote_count(record.guild_id, record.emoji_id, record.added)
 
 
 @client.event
+@metrics.timed('event')
 async def on_app_command_completion(interaction: discord.Interaction, command):
     if interaction.user.id == client.user.id:
         return
@@ -300,24 +691,35 @@ async def on_app_command_completion(interaction: discord.Interaction, command):
     if 'failed' in interaction.extras:
         return
 
-    stat_mapping, _ = on_message_retrieve_guild_data(interaction.guild.id)
-    if stat_mapping:
-        stat_cols = get_stat_col(interaction.channel, stat_mapping, "total_messages")
-        if stat_cols:
-            for col in stat_cols:
-                update_user_stat(interaction.user.id, interaction.guild.id, col, "increment")
+    client.slow_mode.record(interaction.channel.id, interaction.user.id, interaction.channel.slowmode_delay)
+    if client.trace is not None:
+        client.trace.command(interaction.guild.id, interaction.channel.id, interaction.channel.category_id, interaction.user.id,
+                             interaction.channel.slowmode_delay, command.qualified_name)
+
+    config = on_message_retrieve_guild_data(interaction.guild.id)
+    if config:
+        stat_ids = get_stat_col(interaction.channel, config.stat_index, "total_messages")
+        if stat_ids:
+            for stat_id in stat_ids:
+                update_user_stat(interaction.user.id, interaction.guild.id, stat_id, "increment")
 
 
 @client.event
+@metrics.timed('event')
 async def on_raw_reaction_add(event: discord.RawReactionActionEvent):
     if event.emoji.id is not None: # Server emotes have IDs, standard emojis just have names which are their unicode representation
-        update_emote_count(event.guild_id, event.emoji.id, True)
+        if client.trace is not None:
+            client.trace.reaction(event.guild_id, event.emoji.id, True)
+        await client.ingest_queue.put(ingestion.ReactionRecord(event.guild_id, event.emoji.id, True))
 
 
 @client.event
+@metrics.timed('event')
 async def on_raw_reaction_remove(event: discord.RawReactionActionEvent):
     if event.emoji.id is not None:
-        update_emote_count(event.guild_id, event.emoji.id, False)
+        if client.trace is not None:
+            client.trace.reaction(event.guild_id, event.emoji.id, False)
+        await client.ingest_queue.put(ingestion.ReactionRecord(event.guild_id, event.emoji.id, False))
 
 
 def get_stat_description(stat, guild_id):
@@ -344,7 +746,14 @@ def get_stat_description(stat, guild_id):
     return stat_desc
 
 
+@metrics.timed('render')
 def get_server_stats_string(guild_id, stat_mapping):
+    key = (guild_id, None, 'stats')
+    version = client.renders.version(guild_id, None)
+    retval = client.renders.get(key, version)
+    if retval is not None:
+        return retval
+
     if len(stat_mapping['Mapping']) == 0:
         retval = "There are no stats currently being tracked. Try !config to start tracking."
     else:
@@ -355,58 +764,169 @@ def get_server_stats_string(guild_id, stat_mapping):
             retval += f"\n\t**{i}.** *{stat_desc}*"
             i += 1
 
+    client.renders.put(key, version, retval)
     return retval
 
 
+def get_stat_index(guild_id):
+    config = get_guild_config(guild_id)
+    if config is not None:
+        return config.stat_index
+
+
 def get_default_leaderboard(guild_id):
+    config = get_guild_config(guild_id)
+    if config is not None:
+        return config.default_leaderboard
+    else:
+        return None
+
+
+def get_stat_by_leaderboard_id(stat_mapping, leaderboard_id):
+    """Leaderboard ids are the 1-based positions of stats in the mapping, as listed by /stats."""
+    if leaderboard_id is not None and 1 <= leaderboard_id <= len(stat_mapping['Mapping']):
+        return stat_mapping['Mapping'][leaderboard_id - 1]
+    return None
+
+
+def get_leaderboard_id(stat_mapping, stat_id):
+    i = 1
+    for stat in stat_mapping['Mapping']:
+        if stat['StatID'] == stat_id:
+            return i
+        i += 1
+    return None
+
+
+@metrics.timed('db')
+def get_leaderboard_rows(guild_id, stat_id, limit=10):
+    flush_user_stats()
+    conn = create_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT user_id, value FROM user_stats WHERE guild_id = ? AND stat_id = ? ORDER BY value DESC LIMIT ?", (guild_id, stat_id, limit))
+        return cur.fetchall()
+    except Exception as e:
+        print(f"Error getting leaderboard of stat {stat_id} for guild: {guild_id}\n\tError - {e}")
+    finally:
+        release_connection(conn)
+
+
+def get_top_rows(guild_id, stat_id, limit=10):
+    # Boards smaller than the limit can never answer it, LEADERBOARD_CACHE_SIZE may be configured below it
+    if limit > client.leaderboards.size:
+        return get_leaderboard_rows(guild_id, stat_id, limit) or []
+
+    rows = client.leaderboards.top(guild_id, stat_id, limit)
+    if rows is None:
+        db_rows = get_leaderboard_rows(guild_id, stat_id, client.leaderboards.size + 1)
+        if db_rows is None:
+            return []
+        client.leaderboards.rebuild(guild_id, stat_id, db_rows)
+        rows = client.leaderboards.top(guild_id, stat_id, limit)
+    return rows
+
+
+@metrics.timed('db')
+def get_period_rows(guild_id, stat_id, period, limit=10):
+    flush_user_stats()
+    conn = create_connection()
+    try:
+        return rollups.get_period_rows(conn, guild_id, stat_id, period, limit)
+    except Exception as e:
+        print(f"Error getting {period} leaderboard of stat {stat_id} for guild: {guild_id}\n\tError - {e}")
+        return []
+    finally:
+        release_connection(conn)
+
+
+@metrics.timed('db')
+def get_user_rank(guild_id, user_id, stat_id):
+    """Return (rank, value) of the user in the stat, or None if the user has no value for it."""
+    flush_user_stats()
     conn = create_connection()
     cur = conn.cursor()
     try:
-        cur.execute("SELECT default_leaderboard FROM guilds WHERE id = ?", (guild_id,))
+        cur.execute("SELECT value FROM user_stats WHERE guild_id = ? AND stat_id = ? AND user_id = ?", (guild_id, stat_id, user_id))
         rows = cur.fetchall()
-        if rows:
-            return rows[0][0]
-        else:
+        if not rows:
             return None
+
+        value = rows[0][0]
+        cur.execute("SELECT COUNT(*) FROM user_stats WHERE guild_id = ? AND stat_id = ? AND value > ?", (guild_id, stat_id, value))
+        return cur.fetchone()[0] + 1, value
     except Exception as e:
-        print(f"Error getting default leaderboard from guild with id: {guild_id}\n\t Error: {e}")
+        print(f"Error getting rank in stat {stat_id} for guild: {guild_id} and user {user_id}\n\tError - {e}")
     finally:
-        conn.close()
+        release_connection(conn)
+
+
+async def resolve_usernames(guild: discord.Guild, user_ids):
+    """Map each user id to its username, using the caches before REST."""
+    usernames = {}
+    to_fetch = []
+    for user_id in user_ids:
+        user = guild.get_member(user_id) or client.get_user(user_id)
+        if user is not None:
+            usernames[user_id] = user.name
+            continue
+
+        username = client.username_cache.get(user_id)
+        if username is not None:
+            usernames[user_id] = username
+        else:
+            to_fetch.append(user_id)
 
+    async def _fetch(user_id):
+        async with client.user_fetch_semaphore:
+            try:
+                with metrics.timer('rest', 'fetch_user'):
+                    user = await client.rest.call(('fetch_user', user_id), lambda: client.fetch_user(user_id))
+                username = user.name
+            except discord.errors.NotFound:
+                username = "DELETED"
+        client.username_cache.put(user_id, username)
+        usernames[user_id] = username
 
-async def display_leaderboard(interaction: discord.Interaction, leaderboard_id: int):
+    if to_fetch:
+        await asyncio.gather(*(_fetch(user_id) for user_id in to_fetch))
+
+    return usernames
+
+
+async def display_leaderboard(interaction: discord.Interaction, leaderboard_id: int, period: str = None):
     stat_mapping = get_stat_mapping(interaction.guild.id)
-    display_stat = None
-    for stat in stat_mapping['Mapping']:
-        if int(stat['StatCol'][4:]) == leaderboard_id:
-            display_stat = stat
-            break
+    display_stat = get_stat_by_leaderboard_id(stat_mapping, leaderboard_id)
 
     if display_stat is None:
         await reply(interaction, f"Invalid argument '{leaderboard_id}' to command 'leaderboard'.", ephemeral=True)
         return
 
-    stat_desc = get_stat_description(display_stat, interaction.guild.id)
-
-    conn = create_connection()
-    cur = conn.cursor()
-    sql = f"SELECT user_id, stat{leaderboard_id} FROM guilds_users ORDER BY stat{leaderboard_id} DESC LIMIT 10"
-    cur.execute(sql)
-    rows = cur.fetchall()
+    # Period boards are read from the rollups, which change when buffered increments are flushed and as hours pass
+    extra = None if period is None else (client.stat_buffer.flushes, rollups.hour_bucket())
+    key = (interaction.guild.id, display_stat['StatID'], period)
+    version = client.renders.version(interaction.guild.id, display_stat['StatID'], extra)
+    rendered = client.renders.get(key, version)
+    if rendered is None:
+        stat_desc = get_stat_description(display_stat, interaction.guild.id)
+        if period is None:
+            rows = get_top_rows(interaction.guild.id, display_stat['StatID'])
+        else:
+            rows = get_period_rows(interaction.guild.id, display_stat['StatID'], period)
+            stat_desc = f"{stat_desc} ({rollups.PERIOD_NAMES[period]})"
 
-    desc = ""
-    i = 1
-    for row in rows:
-        try:
-            user = await client.fetch_user(row[0])
-            username = user.name
-        except discord.errors.NotFound:
-            username = "DELETED"
+        usernames = await resolve_usernames(interaction.guild, [row[0] for row in rows])
 
-        desc += f"**{i}.** {username} - {row[1]}\n"
-        i += 1
+        with metrics.timer('render', 'display_leaderboard'):
+            desc = ""
+            i = 1
+            for row in rows:
+                desc += f"**{i}.** {usernames[row[0]]} - {row[1]}\n"
+                i += 1
+        rendered = (desc, f"Leaderboard: *{stat_desc}*")
+        client.renders.put(key, version, rendered)
 
-    await send_final_message(interaction, desc, f"Leaderboard: *{stat_desc}*")
+    await send_final_message(interaction, *rendered)
 
 
 async def get_message_input(interaction: discord.Interaction, description, help_text, target_regex, check_function=None, invalid_input=None):
@@ -499,14 +1019,15 @@ async def add_stat(interaction: discord.Interaction):
 
 async def add_stat_to_db(interaction: discord.Interaction, stat_obj):
     guild_id = interaction.guild.id
-    stat_mapping = get_stat_mapping(guild_id)
+    stat_mapping = deepcopy(get_stat_mapping(guild_id))
     num_stats = len(stat_mapping['Mapping'])
     if num_stats >= client.max_stats_per_guild:
         await reply(interaction, f"Error: server already tracking maximum number of stats ({client.max_stats_per_guild}). Delete an existing stat to add another.", view=None)
         return
 
-    statcol = f"stat{num_stats + 1}"
-    stat_obj['StatCol'] = statcol
+    # StatIDs are never reused, so values of a deleted stat can not resurface in a new one
+    stat_obj['StatID'] = stat_mapping.get('NextStatID', 1)
+    stat_mapping['NextStatID'] = stat_obj['StatID'] + 1
     stat_mapping['Mapping'].append(stat_obj)
     stat_str = dumps(stat_mapping)
 
@@ -517,12 +1038,15 @@ async def add_stat_to_db(interaction: discord.Interaction, stat_obj):
         params = (stat_str, guild_id)
         cur.execute(sql, params)
         conn.commit()
+        client.guild_configs.set_stat_mapping(guild_id, stat_mapping)
+        client.renders.invalidate(guild_id)
 
         await reply(interaction, f"Successfully added new stat: {get_stat_description(stat_obj, guild_id)}", view=None)
     except Exception as e:
         print(f"Failed to update stat_mapping for guild: {guild_id} - Error - {e}")
+        client.guild_configs.invalidate(guild_id)
     finally:
-        conn.close()
+        release_connection(conn)
 
 
 async def delete_stat(interaction: discord.Interaction):
@@ -537,59 +1061,67 @@ async def delete_stat(interaction: discord.Interaction):
     i = 0
     for stat in stat_mapping['Mapping']:
         menu_options.append(menu.SelectOption(get_stat_description(stat, guild_id), delete_stat_from_db, 
-                                              {'interaction': interaction, 'stat_mapping': stat_mapping, 'stat_col': stat['StatCol']}, i))
+                                              {'interaction': interaction, 'stat_id': stat['StatID']}, i))
         i += 1
 
     await run_select_menu(interaction, menu_options, "Select which stat to delete:", True)
 
 
-async def delete_stat_from_db(interaction: discord.Interaction, stat_mapping, stat_col):
+async def delete_stat_from_db(interaction: discord.Interaction, stat_id):
     guild_id = interaction.guild.id
-    num_stats = len(stat_mapping['Mapping'])
-    delete_stat_col_num = int(stat_col[4:])
-
-    i = 0
-    for stat in stat_mapping['Mapping']:
-        if stat['StatCol'] == stat_col:
-            stat_mapping['Mapping'].pop(i)
-            break
-        i += 1
-
-    for stat in stat_mapping['Mapping']:
-        stat_col_num = int(stat['StatCol'][4:])
-        if stat_col_num > delete_stat_col_num:
-            stat['StatCol'] = f'stat{stat_col_num - 1}'
+    # The mapping may have changed since the menu was opened
+    stat_mapping = deepcopy(get_stat_mapping(guild_id))
+    leaderboard_id = get_leaderboard_id(stat_mapping, stat_id)
+    if leaderboard_id is None:
+        await reply(interaction, "That stat no longer exists, it may have been deleted already.", ephemeral=True, view=None)
+        return
+    stat_mapping['Mapping'].pop(leaderboard_id - 1)
 
+    # Buffered increments of the stat must be written before its values are purged
+    flush_user_stats()
     default_leaderboard = get_default_leaderboard(guild_id)
     stat_str = dumps(stat_mapping)
     conn = create_connection()
     cur = conn.cursor()
 
     try:
-        if default_leaderboard is not None:
-            if default_leaderboard > delete_stat_col_num:
-                cur.execute("UPDATE guilds SET default_leaderboard = default_leaderboard - 1 WHERE id = ?", (guild_id,))
-            elif default_leaderboard == delete_stat_col_num:
-                cur.execute("UPDATE guilds SET default_leaderboard = NULL WHERE id = ?", (guild_id,))
+        if default_leaderboard == stat_id:
+            cur.execute("UPDATE guilds SET default_leaderboard = NULL WHERE id = ?", (guild_id,))
+            default_leaderboard = None
 
         sql = """UPDATE guilds SET stat_mapping = ? WHERE id = ?"""
         params = (stat_str, guild_id)
         cur.execute(sql, params)
 
-        params = (guild_id,)
-        for i in range(delete_stat_col_num, num_stats):
-            sql = f"""UPDATE guilds_users SET stat{i} = stat{i + 1} WHERE guild_id = ?"""
-            cur.execute(sql, params)
-
-        sql = f"""UPDATE guilds_users SET stat{num_stats} = 0 WHERE guild_id = ?"""
-        cur.execute(sql, params)
-
         conn.commit()
-        await reply(interaction, f"Successfully deleted stat {delete_stat_col_num}.", view=None)
+        client.guild_configs.set_stat_mapping(guild_id, stat_mapping)
+        client.guild_configs.set_default_leaderboard(guild_id, default_leaderboard)
+        client.leaderboards.invalidate(guild_id, stat_id)
+        client.renders.invalidate(guild_id)
+        client.spawn(purge_deleted_stat(guild_id, stat_id))
+        client.spawn(cancel_untracked_backfill_jobs(guild_id, stat_mapping))
+        await reply(interaction, f"Successfully deleted stat {leaderboard_id}.", view=None)
     except Exception as e:
-        print(f"Failed to delete a stat and realign stats for guild: {guild_id} - Deleted stat num: {delete_stat_col_num}\n\tError - {e}")
+        print(f"Failed to delete a stat for guild: {guild_id} - Deleted stat id: {stat_id}\n\tError - {e}")
+        client.guild_configs.invalidate(guild_id)
     finally:
-        conn.close()
+        release_connection(conn)
+
+
+async def purge_deleted_stat(guild_id, stat_id):
+    """Delete a removed stat's values in small batches. Leftover rows are harmless since StatIDs are never reused."""
+    deleted = -1
+    while deleted != 0:
+        conn = create_connection()
+        try:
+            deleted = database.purge_stat(conn, guild_id, stat_id, client.stat_purge_batch_size)
+            deleted += rollups.purge_stat(conn, guild_id, stat_id, client.stat_purge_batch_size)
+        except Exception as e:
+            print(f"Failed to purge values of deleted stat {stat_id} for guild: {guild_id}\n\tError - {e}")
+            return
+        finally:
+            release_connection(conn)
+        await asyncio.sleep(0)
 
 
 async def setup_die(interaction: discord.Interaction, new_interaction: discord.Interaction):
@@ -639,27 +1171,30 @@ async def change_default_leaderboard(interaction: discord.Interaction):
     i = 0
     for stat in stat_mapping['Mapping']:
         menu_options.append(menu.SelectOption(get_stat_description(stat, guild_id), change_default_leaderboard_db, 
-                                              {'interaction': interaction, 'default_leaderboard_num': int(stat['StatCol'][4:])}, i))
+                                              {'interaction': interaction, 'default_stat_id': stat['StatID']}, i))
         i += 1
 
     await run_select_menu(interaction, menu_options, "Select which stat you would like to be shown in the default leaderboard:", True)
 
 
-async def change_default_leaderboard_db(interaction: discord.Interaction, default_leaderboard_num: int):
+async def change_default_leaderboard_db(interaction: discord.Interaction, default_stat_id: int):
+    """default_leaderboard holds the StatID of the default stat."""
     guild_id = interaction.guild.id
     conn = create_connection()
     cur = conn.cursor()
     try:
         sql = "UPDATE guilds SET default_leaderboard = ? WHERE id = ?"
-        params = (default_leaderboard_num, guild_id)
+        params = (default_stat_id, guild_id)
         cur.execute(sql, params)
         conn.commit()
+        client.guild_configs.set_default_leaderboard(guild_id, default_stat_id)
 
         await reply(interaction, "Successfully changed default leaderboard.", view=None)
     except Exception as e:
         print(f"Failed to update default_leaderboard for guild: {guild_id} - Error - {e}")
+        client.guild_configs.invalidate(guild_id)
     finally:
-        conn.close()
+        release_connection(conn)
 
 
 async def manage_permissions(interaction: discord.Interaction):
@@ -672,19 +1207,11 @@ async def manage_permissions(interaction: discord.Interaction):
     return
 
 def get_config_roles(guild_id):
-    conn = create_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute("SELECT config_roles FROM guilds WHERE id = ?", (guild_id,))
-        rows = cur.fetchall()
-        if rows:
-            return rows[0][0]
-        else:
-            return None
-    except Exception as e:
-        print(f"Error getting config_roles from guild with id: {guild_id}\n\t Error: {e}")
-    finally:
-        conn.close()
+    config = get_guild_config(guild_id)
+    if config is not None and config.config_roles:
+        return ','.join(str(v) for v in config.config_roles)
+    else:
+        return None
 
 
 def get_role_name(guild_roles, role_id):
@@ -769,15 +1296,221 @@ async def delete_role_from_config_roles(interaction: discord.Interaction):
     return
 
 
-async def _count_channel_history(channel: discord.abc.GuildChannel, users, after: datetime.datetime = None):
-    async for message in channel.history(limit=None, after=after):
-        if message.author.bot:
+# Most messages Discord returns per history request
+HISTORY_PAGE_SIZE = 100
+
+
+@metrics.timed('backfill')
+async def _count_channel_history(channel: discord.abc.GuildChannel, users, after: datetime.datetime = None, progress: backfill.BackfillProgress = None,
+                                 checkpoint=None, checkpoint_every: int = 1000, spill_users: int = None):
+    """Count messages per user in the channel, oldest first, calling checkpoint(last_message_id, done) as it goes."""
+    last_message_id = None
+    since_checkpoint = 0
+    while True:
+        # One history request per page, so every request waits for its turn and holds a background slot
+        async with client.rest.background():
+            page = [message async for message in channel.history(limit=HISTORY_PAGE_SIZE, after=after, oldest_first=True)]
+        for message in page:
+            last_message_id = message.id
+            if progress is not None:
+                progress.messages += 1
+
+            if not message.author.bot:
+                if message.author.id not in users.keys():
+                    users[message.author.id] = 1
+                else:
+                    users[message.author.id] += 1
+
+            if checkpoint is not None:
+                since_checkpoint += 1
+                if since_checkpoint >= checkpoint_every or (spill_users is not None and len(users) >= spill_users):
+                    checkpoint(last_message_id, False)
+                    since_checkpoint = 0
+
+        if len(page) < HISTORY_PAGE_SIZE:
+            break
+        after = discord.Object(id=last_message_id)
+
+    if checkpoint is not None:
+        checkpoint(last_message_id, True)
+
+
+async def _report_backfill_progress(interaction: discord.Interaction, progress: backfill.BackfillProgress):
+    while not progress.finished:
+        await asyncio.sleep(client.history_progress_interval)
+        if progress.finished:
+            break
+        try:
+            await reply(interaction, progress.summary(), ephemeral=True)
+        except discord.HTTPException as e:
+            # The interaction token expires after 15 minutes, the backfill itself carries on
+            print(f"Stopped reporting backfill progress. Error: {e}")
+            break
+
+
+@metrics.timed('db')
+def write_backfill_checkpoint(job_id, channel_id, last_message_id, users, done):
+    conn = create_connection()
+    try:
+        backfill.checkpoint(conn, job_id, channel_id, last_message_id, users, done)
+        users.clear()
+    finally:
+        release_connection(conn)
+
+
+@metrics.timed('backfill')
+async def run_backfill_job(job_id, guild_id, stat_ids, after: datetime.datetime = None, interaction: discord.Interaction = None, done_msg: str = None):
+    """Count the history of the job's unfinished channels concurrently, then write the totals to its stats."""
+    conn = create_connection()
+    try:
+        job = backfill.get_job(conn, job_id)
+        pending = backfill.get_pending_channels(conn, job_id)
+    finally:
+        release_connection(conn)
+
+    progress = backfill.BackfillProgress(job[8], job[7])
+    client.backfill_progress[job_id] = progress
+    semaphore = asyncio.Semaphore(client.history_concurrency)
+
+    async def _count_one(channel_id, last_message_id):
+        async with semaphore:
+            users = {}
+
+            def _checkpoint(checkpoint_message_id, done):
+                write_backfill_checkpoint(job_id, channel_id, checkpoint_message_id, users, done)
+
+            channel = client.get_channel(channel_id)
+            if channel is None:
+                print(f"Channel id {channel_id} no longer exists, skipping it in backfill job {job_id}.")
+                _checkpoint(None, True)
+            else:
+                channel_after = discord.Object(id=last_message_id) if last_message_id is not None else after
+                try:
+                    await _count_channel_history(channel, users, channel_after, progress, _checkpoint,
+                                                 client.backfill_checkpoint_messages, client.backfill_spill_users)
+                except discord.Forbidden:
+                    print(f"Missing access to count history of channel id {channel_id} in guild id {guild_id}.")
+                    _checkpoint(None, True)
+            progress.channels_done += 1
+
+    reporter = asyncio.create_task(_report_backfill_progress(interaction, progress)) if interaction is not None else None
+    try:
+        scans = [asyncio.create_task(_count_one(channel_id, last_message_id)) for channel_id, last_message_id in pending]
+        try:
+            await asyncio.gather(*scans)
+        except BaseException:
+            # Stop the other scans before the job is ended, so they write no rows for it afterwards
+            for scan in scans:
+                scan.cancel()
+            await asyncio.gather(*scans, return_exceptions=True)
+            raise
+
+        flush_user_stats()
+        # Stats deleted meanwhile are skipped
+        tracked_stat_ids = [stat['StatID'] for stat in get_stat_mapping(guild_id)['Mapping']]
+        stat_ids = [stat_id for stat_id in stat_ids if stat_id in tracked_stat_ids]
+        conn = create_connection()
+        started = time.perf_counter()
+        try:
+            rows = backfill.finish_job(conn, job_id, guild_id, stat_ids)
+            elapsed = time.perf_counter() - started
+            print(f"Backfill job {job_id} wrote {rows} rows to stats {stat_ids} for guild: {guild_id} ({rows / elapsed if elapsed > 0 else 0:.0f} rows/sec)")
+        finally:
+            release_connection(conn)
+        for stat_id in stat_ids:
+            client.leaderboards.invalidate(guild_id, stat_id)
+            client.renders.invalidate(guild_id, stat_id)
+    except asyncio.CancelledError:
+        # Either cancelled by command, which records it, or the bot is shutting down and the job resumes on restart
+        raise
+    except Exception as e:
+        print(f"Backfill job {job_id} for guild id {guild_id} failed.\n\tError - {e}")
+        conn = create_connection()
+        try:
+            backfill.end_job(conn, job_id, 'failed')
+        finally:
+            release_connection(conn)
+        return
+    finally:
+        progress.finished = True
+        if reporter is not None:
+            reporter.cancel()
+        client.backfill_tasks.pop(job_id, None)
+        client.backfill_progress.pop(job_id, None)
+
+    print(f"Backfill job {job_id} counted {progress.channels_done} channels in guild id {guild_id}: {progress.messages} messages at {progress.rate():.1f} messages/sec")
+    if interaction is not None and done_msg is not None:
+        try:
+            await reply(interaction, done_msg, ephemeral=True)
+        except discord.HTTPException:
+            pass
+
+
+async def start_backfill_job(interaction: discord.Interaction, scope, scope_id, channels, stat_ids, after: datetime.datetime, done_msg):
+    conn = create_connection()
+    try:
+        job_id = backfill.create_job(conn, interaction.guild_id, scope, scope_id, stat_ids, after, [channel.id for channel in channels])
+    except Exception as e:
+        print(f"Failed to create backfill job for guild: {interaction.guild_id}\n\tError - {e}")
+        await reply(interaction, "Failed to start counting history.", ephemeral=True)
+        return
+    finally:
+        release_connection(conn)
+
+    await reply(interaction, f"Started counting history as job {job_id}. Use /backfillstatus to check on it.", ephemeral=True)
+    client.backfill_tasks[job_id] = asyncio.create_task(run_backfill_job(job_id, interaction.guild_id, stat_ids, after, interaction, done_msg))
+
+
+async def resume_backfill_jobs():
+    await client.wait_until_ready()
+    conn = create_connection()
+    try:
+        jobs = backfill.get_jobs(conn, status='running')
+    except Exception as e:
+        print(f"Failed to load backfill jobs to resume. Error: {e}")
+        return
+    finally:
+        release_connection(conn)
+
+    for job in jobs:
+        job_id, guild_id, stat_ids, after = job[0], job[1], [int(stat_id) for stat_id in job[4].split(',')], job[5]
+        if job_id in client.backfill_tasks or not client.owns_guild(guild_id):
             continue
+        after_datetime = datetime.datetime.fromisoformat(after) if after else None
+        print(f"Resuming backfill job {job_id} for guild id {guild_id}. Channels done: {job[7]}/{job[8]}")
+        client.backfill_tasks[job_id] = asyncio.create_task(run_backfill_job(job_id, guild_id, stat_ids, after_datetime))
 
-        if message.author.id not in users.keys():
-            users[message.author.id] = 1
-        else:
-            users[message.author.id] += 1
+
+async def cancel_backfill_job(job_id):
+    # The job's scans must be stopped before it is ended, so they write no rows for it afterwards
+    task = client.backfill_tasks.pop(job_id, None)
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    conn = create_connection()
+    try:
+        backfill.end_job(conn, job_id, 'cancelled')
+    finally:
+        release_connection(conn)
+
+
+async def cancel_untracked_backfill_jobs(guild_id, stat_mapping):
+    """Cancel the guild's running jobs that no longer count towards any of its stats."""
+    tracked_stat_ids = {stat['StatID'] for stat in stat_mapping['Mapping']}
+    conn = create_connection()
+    try:
+        jobs = backfill.get_jobs(conn, guild_id, 'running')
+    except Exception as e:
+        print(f"Failed to load backfill jobs of guild: {guild_id}\n\tError - {e}")
+        return
+    finally:
+        release_connection(conn)
+
+    for job in jobs:
+        if tracked_stat_ids.isdisjoint(int(stat_id) for stat_id in job[4].split(',')):
+            print(f"Cancelling backfill job {job[0]} for guild id {guild_id}, its stats were deleted.")
+            await cancel_backfill_job(job[0])
 
 
 @client.tree.command(name="d", description="Roll a die with the given number of sides", extras={"behave_as_message": True})
@@ -794,34 +1527,36 @@ async def dice_roll(interaction: discord.Interaction, sides: int):
     await interaction.response.send_message(embed=msg_embed)
     msg = await interaction.original_response()
 
-    stat_mapping = get_stat_mapping(interaction.guild.id)
-    if stat_mapping:
-        stat_cols = get_stat_col(interaction.channel, stat_mapping, "Dice", DiceType=sides, DiceResult=roll_result)
-        if stat_cols:
+    stat_index = get_stat_index(interaction.guild.id)
+    if stat_index:
+        stat_ids = get_stat_col(interaction.channel, stat_index, "Dice", DiceType=sides, DiceResult=roll_result)
+        if stat_ids:
             await msg.add_reaction('🎉')
-            for col in stat_cols:
-                update_user_stat(user.id, interaction.guild.id, col, "increment")
+            for stat_id in stat_ids:
+                update_user_stat(user.id, interaction.guild.id, stat_id, "increment")
 
 
 @client.tree.command(name='leaderboard', description="View a leaderboard", extras={"behave_as_message": True})
-@app_commands.describe(leaderboard_id='Id of the leaderboard you wish to view')
-async def leaderboard(interaction: discord.Interaction, leaderboard_id: Optional[int] = None):
+@app_commands.describe(leaderboard_id='Id of the leaderboard you wish to view', period='Only count activity within this period. Defaults to all time')
+@app_commands.choices(period=[app_commands.Choice(name=name, value=period) for period, name in rollups.PERIOD_NAMES.items()])
+async def leaderboard(interaction: discord.Interaction, leaderboard_id: Optional[int] = None, period: Optional[app_commands.Choice[str]] = None):
     if not await verify_slow_mode(interaction):
         return
 
+    period = period.value if period is not None else None
     if leaderboard_id is not None:
-        await display_leaderboard(interaction, leaderboard_id)
+        await display_leaderboard(interaction, leaderboard_id, period)
         return
 
-    default_leaderboard = get_default_leaderboard(interaction.guild.id)
+    stat_mapping = get_stat_mapping(interaction.guild.id)
+    default_leaderboard = get_leaderboard_id(stat_mapping, get_default_leaderboard(interaction.guild.id))
     if default_leaderboard:
-        await display_leaderboard(interaction, default_leaderboard)
+        await display_leaderboard(interaction, default_leaderboard, period)
         return
 
-    stat_mapping = get_stat_mapping(interaction.guild.id)
     num_stats = len(stat_mapping['Mapping'])
     if num_stats == 1:
-        await display_leaderboard(interaction, 1)
+        await display_leaderboard(interaction, 1, period)
         return
 
     i = 1
@@ -829,13 +1564,38 @@ async def leaderboard(interaction: discord.Interaction, leaderboard_id: Optional
     for stat in stat_mapping['Mapping']:
         menu_options.append(menu.SelectOption(f'{i}. {get_stat_description(stat, interaction.guild.id)}',
                                               display_leaderboard,
-                                              {'leaderboard_id': i, 'interaction': interaction},
+                                              {'leaderboard_id': i, 'interaction': interaction, 'period': period},
                                               i - 1))
         i += 1
 
     await run_select_menu(interaction, menu_options, 'Select Leaderboard:', True)
 
 
+@client.tree.command(name='rank', description="View your rank on a leaderboard", extras={"behave_as_message": True})
+@app_commands.describe(leaderboard_id='Id of the leaderboard to view your rank on')
+async def display_rank(interaction: discord.Interaction, leaderboard_id: Optional[int] = None):
+    if not await verify_slow_mode(interaction):
+        return
+
+    stat_mapping = get_stat_mapping(interaction.guild.id)
+    if leaderboard_id is None:
+        leaderboard_id = get_leaderboard_id(stat_mapping, get_default_leaderboard(interaction.guild.id))
+    if leaderboard_id is None and len(stat_mapping['Mapping']) == 1:
+        leaderboard_id = 1
+
+    display_stat = get_stat_by_leaderboard_id(stat_mapping, leaderboard_id)
+    if display_stat is None:
+        await reply(interaction, f"Invalid argument '{leaderboard_id}' to command 'rank'. Use /stats to see leaderboard ids.", ephemeral=True)
+        return
+
+    stat_desc = get_stat_description(display_stat, interaction.guild.id)
+    rank = get_user_rank(interaction.guild.id, interaction.user.id, display_stat['StatID'])
+    if rank is None:
+        await reply(interaction, f"{interaction.user.name} is not ranked yet.", f"Rank: *{stat_desc}*")
+    else:
+        await reply(interaction, f"**{rank[0]}.** {interaction.user.name} - {rank[1]}", f"Rank: *{stat_desc}*")
+
+
 @client.tree.command(name='config', description="Configure the bot")
 @app_commands.default_permissions()
 async def start_config(interaction: discord.Interaction):
@@ -878,8 +1638,8 @@ async def display_tracked_stats(interaction: discord.Interaction):
     await reply(interaction, get_server_stats_string(interaction.guild_id, get_stat_mapping(interaction.guild_id)), "Tracked stats:")
 
 
-# May be good to put in some type of limit to each message history counter.
-# Holding the users object in memory may not work for really large servers with many users.
+# History counts run as persisted backfill jobs, see run_backfill_job. Per-user counts are spilled to the backfill_counts
+# staging table as they are counted, so memory use does not grow with the size of the server.
 @client.tree.command(name='countchannelhistory', description="Count the number of historical messages in the current channel")
 @app_commands.describe(after='Count history for messages sent after this datetime. UTC datetime in format: YYYY-mm-dd hh:MM')
 @app_commands.default_permissions()
@@ -898,17 +1658,12 @@ async def count_channel_history(interaction: discord.Interaction, after: Optiona
             await reply(interaction, "Invalid 'after' datetime given. Please verify format is YYYY-mm-dd hh:MM")
             return
 
-    stat_mapping = get_stat_mapping(interaction.guild_id)
-    if stat_mapping:
-        stat_cols = get_stat_col(channel, stat_mapping, "total_messages", ChannelOnly=True)
-        if stat_cols:
+    stat_index = get_stat_index(interaction.guild_id)
+    if stat_index:
+        stat_ids = get_stat_col(channel, stat_index, "total_messages", ChannelOnly=True)
+        if stat_ids:
             await interaction.response.defer(ephemeral=True, thinking=True)
-            users = {}
-            await _count_channel_history(channel, users, after_datetime)
-            for col in stat_cols:
-                for user, user_val in users.items():
-                    update_user_stat(user, channel.guild.id, col, user_val)
-            await reply(interaction, "Successfully counted channel history.", ephemeral=True)
+            await start_backfill_job(interaction, 'Channel', channel.id, [channel], stat_ids, after_datetime, "Successfully counted channel history.")
         else:
             await reply(interaction, f"Messages in channel '{channel.name}' are not tracked. Try config to start tracking.", ephemeral=True)
 
@@ -941,18 +1696,12 @@ async def count_category_history(interaction: discord.Interaction, after: Option
         return
 
     channel = category.channels[0]
-    stat_mapping = get_stat_mapping(interaction.guild_id)
-    if stat_mapping:
-        stat_cols = get_stat_col(channel, stat_mapping, "total_messages", CategoryOnly=True)
-        if stat_cols:
+    stat_index = get_stat_index(interaction.guild_id)
+    if stat_index:
+        stat_ids = get_stat_col(channel, stat_index, "total_messages", CategoryOnly=True)
+        if stat_ids:
             await interaction.response.defer(ephemeral=True, thinking=True)
-            users = {}
-            for channel in channel.category.text_channels:
-                await _count_channel_history(channel, users, after_datetime)
-            for col in stat_cols:
-                for user, user_val in users.items():
-                    update_user_stat(user, channel.guild.id, col, user_val)
-            await reply(interaction, "Successfully counted category history.", ephemeral=True)
+            await start_backfill_job(interaction, 'Category', category.id, category.text_channels, stat_ids, after_datetime, "Successfully counted category history.")
         else:
             await reply(interaction, f"Messages in category '{category.name}' are not tracked. Try config to start tracking.")
 
@@ -969,39 +1718,77 @@ async def count_guild_history(interaction: discord.Interaction, after: Optional[
             await reply(interaction, "Invalid 'after' datetime given. Please verify format is YYYY-mm-dd hh:MM")
             return
 
-    stat_mapping = get_stat_mapping(interaction.guild_id)
-    if stat_mapping:
-        stat_cols = get_stat_col(interaction.channel, stat_mapping, "total_messages", GuildOnly=True)
-        if stat_cols:
+    stat_index = get_stat_index(interaction.guild_id)
+    if stat_index:
+        stat_ids = get_stat_col(interaction.channel, stat_index, "total_messages", GuildOnly=True)
+        if stat_ids:
             await interaction.response.defer(ephemeral=True, thinking=True)
-            users = {}
-            for channel in interaction.guild.text_channels:
-                await _count_channel_history(channel, users, after_datetime)
-            for col in stat_cols:
-                for user, user_val in users.items():
-                    update_user_stat(user, interaction.guild_id, col, user_val)
-            await reply(interaction, "Successfully counted guild history.", ephemeral=True)
+            await start_backfill_job(interaction, 'Guild', interaction.guild_id, interaction.guild.text_channels, stat_ids, after_datetime, "Successfully counted guild history.")
         else:
             await reply(interaction, "Total server messages not tracked. Try config to start tracking.")
 
 
+@client.tree.command(name='backfillstatus', description="View the history counting jobs of this server")
+@app_commands.default_permissions()
+async def display_backfill_status(interaction: discord.Interaction):
+    conn = create_connection()
+    try:
+        jobs = backfill.get_jobs(conn, interaction.guild_id)
+    finally:
+        release_connection(conn)
+
+    if not jobs:
+        await reply(interaction, "No history counting jobs have been run in this server.", ephemeral=True)
+        return
+
+    desc = ""
+    for job in jobs[-10:]:
+        desc += f"**{job[0]}.** {job[2]} history - {job[6]}, channels done: {job[7]}/{job[8]}"
+        progress = client.backfill_progress.get(job[0])
+        if progress is not None:
+            desc += f", {progress.messages} messages ({progress.rate():.1f}/sec)"
+        desc += "\n"
+
+    await reply(interaction, desc, "History counting jobs:", ephemeral=True)
+
+
+@client.tree.command(name='cancelbackfill', description="Cancel a running history counting job")
+@app_commands.describe(job_id='Id of the job to cancel, as shown by backfillstatus')
+@app_commands.default_permissions()
+async def cancel_backfill(interaction: discord.Interaction, job_id: int):
+    conn = create_connection()
+    try:
+        jobs = backfill.get_jobs(conn, interaction.guild_id, 'running')
+    finally:
+        release_connection(conn)
+
+    if job_id not in [job[0] for job in jobs]:
+        await reply(interaction, f"No running history counting job with id '{job_id}'.", ephemeral=True)
+        return
+
+    await cancel_backfill_job(job_id)
+    await reply(interaction, f"Cancelled history counting job {job_id}.", ephemeral=True)
+
+
 @client.tree.command(name='emojis', description="View a leaderboard of the most popular server emojis", extras={"behave_as_message": True})
 @app_commands.describe(show_all='View all emojis')
 async def display_emoji_leaderboard(interaction: discord.Interaction, show_all: Optional[bool] = None):
     conn = create_connection()
     cur = conn.cursor()
     sql = f"SELECT emote_id, emote_count FROM guilds_emotes WHERE guild_id = ? ORDER BY emote_count DESC {'' if show_all else 'LIMIT 10'}"
-    cur.execute(sql, (interaction.guild.id,))
-    rows = cur.fetchall()
+    try:
+        cur.execute(sql, (interaction.guild.id,))
+        rows = cur.fetchall()
+    finally:
+        release_connection(conn)
 
     desc = ""
     i = 1
     for row in rows:
-        try:
-            emoji = await interaction.guild.fetch_emoji(row[0])
-            emoji_name = emoji.name
-            emoji_id = emoji.id
-        except discord.errors.NotFound:
+        emoji_name = await get_guild_emoji_name(interaction.guild, row[0])
+        if emoji_name is not None:
+            emoji_id = row[0]
+        else:
             emoji_name = "DELETED"
             emoji_id = None
 
@@ -1014,4 +1801,5 @@ async def display_emoji_leaderboard(interaction: discord.Interaction, show_all:
     await reply(interaction, desc, "Emoji Leaderboard")
 
 
-client.run(config_vars['BOT_TOKEN'])
+if __name__ == '__main__':
+    client.run(config_vars['BOT_TOKEN'])
@@ -0,0 +1,187 @@
+"""Counters and latency histograms exposed in the Prometheus text format"""
+
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from functools import wraps
+import profiling
+
+
+# Metrics are served when given a port, and also collected for the phase breakdown of profiling mode. When neither is
+# enabled, `timed` returns functions unchanged and `timer` a shared no-op context manager, so instrumented code runs
+# as if it was not instrumented.
+PORT = int(os.getenv('LEADERBOARDS_BOT_METRICS_PORT') or 0)
+ENABLED = PORT > 0 or profiling.ENABLED
+
+# Upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_NULL_TIMER = nullcontext()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """Latency histograms keyed by (kind, name), e.g. ('db', 'get_user_rank'), counters keyed by (metric, labels),
+    and gauges and counters read from callbacks when scraped."""
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.counter_callbacks = {}
+        self.gauges = {}
+
+
+    def observe(self, kind, name, seconds):
+        histogram = self.histograms.get((kind, name))
+        if histogram is None:
+            histogram = self.histograms[(kind, name)] = Histogram()
+        histogram.observe(seconds)
+
+
+    def inc(self, metric, labels=(), amount=1):
+        key = (metric, tuple(labels))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+
+    def gauge(self, metric, callback):
+        self.gauges[metric] = callback
+
+
+    def counter(self, metric, callback):
+        """Export the monotonically increasing count returned by callback."""
+        self.counter_callbacks[metric] = callback
+
+
+    def render(self):
+        lines = []
+        for kind in sorted({kind for kind, _ in self.histograms}):
+            metric = f"leaderboards_{kind}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for (histogram_kind, name), histogram in sorted(self.histograms.items()):
+                if histogram_kind != kind:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{name="{name}"}} {histogram.sum}')
+                lines.append(f'{metric}_count{{name="{name}"}} {histogram.count}')
+
+        for metric in sorted({metric for metric, _ in self.counters}):
+            lines.append(f"# TYPE {metric} counter")
+            for (counter_metric, labels), value in sorted(self.counters.items()):
+                if counter_metric == metric:
+                    lines.append(f"{metric}{_labels(labels)} {value}")
+
+        for metric_type, callbacks in (('counter', self.counter_callbacks), ('gauge', self.gauges)):
+            for metric, callback in sorted(callbacks.items()):
+                try:
+                    value = callback()
+                except Exception:
+                    continue
+                lines.append(f"# TYPE {metric} {metric_type}")
+                lines.append(f"{metric} {value}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+REGISTRY = Registry()
+
+
+class _Timer:
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+
+
+    def __enter__(self):
+        self.invocation = profiling.enter_phase(self.kind)
+        self.started = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        REGISTRY.observe(self.kind, self.name, elapsed)
+        if self.invocation is not None:
+            profiling.exit_phase(self.invocation, self.kind, elapsed)
+        if exc_type is not None:
+            REGISTRY.inc(f"leaderboards_{self.kind}_errors_total", (('name', self.name),))
+        return False
+
+
+def timer(kind, name):
+    """Context manager timing its block into the (kind, name) histogram, and counting exceptions raised from it."""
+    if not ENABLED:
+        return _NULL_TIMER
+    return _Timer(kind, name)
+
+
+def timed(kind, name=None):
+    """Decorator timing every call of a function or coroutine function into the (kind, name) histogram.
+    The name defaults to the function's name."""
+    def decorator(func):
+        if not ENABLED:
+            return func
+        metric_name = name or func.__name__
+
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with _Timer(kind, metric_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(kind, metric_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def _handle_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Skip the headers, the request itself does not matter beyond its path
+        while (await reader.readline()).strip():
+            pass
+
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[1].split('?')[0] == '/metrics':
+            status, body = "200 OK", REGISTRY.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception as e:
+        print(f"Failed to serve metrics request. Error: {e}")
+    finally:
+        writer.close()
+
+
+async def serve(host='127.0.0.1', port=PORT):
+    """Serve GET /metrics on the local interface. Returns the asyncio server."""
+    server = await asyncio.start_server(_handle_request, host, port)
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
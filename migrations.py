@@ -0,0 +1,260 @@
+"""Versioned database schema migrations"""
+
+import re
+from json import loads, dumps
+from typing import Callable, Iterator, NamedTuple
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[..., Iterator[int]]
+    estimate: Callable[..., int]
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _set_version(conn, version):
+    conn.execute(f"PRAGMA user_version = {int(version)}")
+    conn.commit()
+
+
+def table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+def get_stat_columns(conn):
+    """Return the legacy stat columns of guilds_users in order, e.g. ['stat1', 'stat2', 'stat3']."""
+    cols = [row[1] for row in conn.execute("PRAGMA table_info(guilds_users)") if re.fullmatch(r'stat\d+', row[1])]
+    return sorted(cols, key=lambda col: int(col[4:]))
+
+
+def _no_rows(conn):
+    return 0
+
+
+def _create_base_tables(conn, batch_size):
+    conn.execute("""CREATE TABLE IF NOT EXISTS guilds (
+                        id integer NOT NULL PRIMARY KEY,
+                        created_date text DEFAULT (strftime('%Y-%m-%d %H:%M:%S:%s','now', 'localtime')),
+                        updated_date text DEFAULT (strftime('%Y-%m-%d %H:%M:%S:%s','now', 'localtime')),
+                        config_roles text DEFAULT NULL,
+                        default_leaderboard integer DEFAULT NULL,
+                        stat_mapping text DEFAULT '{"Mapping":[]}'
+                    )""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS update_guilds_updated_date AFTER UPDATE ON guilds
+                    begin
+                        UPDATE guilds SET updated_date = strftime('%Y-%m-%d %H:%M:%S:%s','now', 'localtime') where id = old.id;
+                    end""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS guilds_emotes (
+                        guild_id integer NOT NULL,
+                        emote_id integer NOT NULL,
+                        emote_count integer NOT NULL DEFAULT 0,
+                        FOREIGN KEY (guild_id) REFERENCES guilds(id),
+                        PRIMARY KEY (guild_id, emote_id)
+                    )""")
+    conn.commit()
+    yield 0
+
+
+def _guilds_to_migrate(conn):
+    """Yield (guild_id, stat_mapping) of guilds whose stat_mapping still refers to guilds_users columns."""
+    for guild_id, stat_mapping_str in conn.execute("SELECT id, stat_mapping FROM guilds").fetchall():
+        stat_mapping = loads(stat_mapping_str)
+        if any('StatCol' in stat for stat in stat_mapping['Mapping']):
+            yield guild_id, stat_mapping
+
+
+def _create_user_stats(conn, batch_size):
+    """Copy the fixed stat1..statN columns of guilds_users into user_stats, in batches of users per stat.
+    Each mapped 'StatCol': 'statN' becomes 'StatID': N, so default_leaderboard values stay valid unchanged. A guild's
+    mapping is only rewritten after all its values are copied, so an interrupted run simply copies that guild again."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS user_stats (
+                        guild_id integer NOT NULL,
+                        stat_id integer NOT NULL,
+                        user_id integer NOT NULL,
+                        value integer NOT NULL DEFAULT 0,
+                        PRIMARY KEY (guild_id, stat_id, user_id)
+                    ) WITHOUT ROWID""")
+    conn.commit()
+    if not table_exists(conn, 'guilds_users'):
+        return
+
+    stat_columns = set(get_stat_columns(conn))
+    for guild_id, stat_mapping in _guilds_to_migrate(conn):
+        for stat in stat_mapping['Mapping']:
+            stat_col = stat.pop('StatCol', None)
+            if stat_col is None:
+                continue
+            stat['StatID'] = int(stat_col[4:])
+            if stat_col not in stat_columns:
+                continue
+
+            last_user_id = -1
+            while True:
+                rows = conn.execute(f"""SELECT user_id, {stat_col} FROM guilds_users
+                                        WHERE guild_id = ? AND user_id > ? AND {stat_col} != 0 ORDER BY user_id LIMIT ?""",
+                                    (guild_id, last_user_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                conn.executemany("INSERT OR REPLACE INTO user_stats(guild_id, stat_id, user_id, value) VALUES (?,?,?,?)",
+                                 [(guild_id, stat['StatID'], user_id, value) for user_id, value in rows])
+                conn.commit()
+                last_user_id = rows[-1][0]
+                yield len(rows)
+
+        stat_mapping['NextStatID'] = max(stat['StatID'] for stat in stat_mapping['Mapping']) + 1
+        conn.execute("UPDATE guilds SET stat_mapping = ? WHERE id = ?", (dumps(stat_mapping), guild_id))
+        conn.commit()
+        yield 1
+
+
+def _estimate_user_stats(conn):
+    if not table_exists(conn, 'guilds_users'):
+        return 0
+
+    rows = 0
+    for guild_id, stat_mapping in _guilds_to_migrate(conn):
+        num_users = conn.execute("SELECT COUNT(*) FROM guilds_users WHERE guild_id = ?", (guild_id,)).fetchone()[0]
+        rows += num_users * sum(1 for stat in stat_mapping['Mapping'] if 'StatCol' in stat) + 1
+    return rows
+
+
+def _create_backfill_tables(conn, batch_size):
+    conn.execute("""CREATE TABLE IF NOT EXISTS backfill_jobs (
+                        id integer NOT NULL PRIMARY KEY,
+                        guild_id integer NOT NULL,
+                        scope text NOT NULL,
+                        scope_id integer NOT NULL,
+                        stat_ids text NOT NULL,
+                        after text DEFAULT NULL,
+                        status text NOT NULL DEFAULT 'running',
+                        created_date text DEFAULT (strftime('%Y-%m-%d %H:%M:%S:%s','now', 'localtime'))
+                    )""")
+    # Jobs created before stats were normalized refer to guilds_users columns
+    if 'stat_cols' in [row[1] for row in conn.execute("PRAGMA table_info(backfill_jobs)")]:
+        conn.execute("ALTER TABLE backfill_jobs RENAME COLUMN stat_cols TO stat_ids")
+        conn.execute("UPDATE backfill_jobs SET stat_ids = replace(stat_ids, 'stat', '')")
+    conn.execute("""CREATE TABLE IF NOT EXISTS backfill_channels (
+                        job_id integer NOT NULL,
+                        channel_id integer NOT NULL,
+                        last_message_id integer DEFAULT NULL,
+                        done integer NOT NULL DEFAULT 0,
+                        FOREIGN KEY (job_id) REFERENCES backfill_jobs(id),
+                        PRIMARY KEY (job_id, channel_id)
+                    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS backfill_counts (
+                        job_id integer NOT NULL,
+                        user_id integer NOT NULL,
+                        count integer NOT NULL DEFAULT 0,
+                        FOREIGN KEY (job_id) REFERENCES backfill_jobs(id),
+                        PRIMARY KEY (job_id, user_id)
+                    )""")
+    conn.commit()
+    yield 0
+
+
+def _create_leaderboard_indexes(conn, batch_size):
+    # An index is built by a single statement, it cannot be split into batches
+    conn.execute("CREATE INDEX IF NOT EXISTS user_stats_value_idx ON user_stats(guild_id, stat_id, value DESC)")
+    conn.commit()
+    yield conn.execute("SELECT COUNT(*) FROM user_stats").fetchone()[0]
+    conn.execute("CREATE INDEX IF NOT EXISTS guilds_emotes_count_idx ON guilds_emotes(guild_id, emote_count DESC)")
+    conn.commit()
+    yield conn.execute("SELECT COUNT(*) FROM guilds_emotes").fetchone()[0]
+
+
+def _legacy_stat_rows(conn):
+    """Count the user_stats rows migration 2 has yet to copy: the non-zero mapped guilds_users values."""
+    if not table_exists(conn, 'guilds_users'):
+        return 0
+
+    stat_columns = set(get_stat_columns(conn))
+    rows = 0
+    for guild_id, stat_mapping in _guilds_to_migrate(conn):
+        for stat in stat_mapping['Mapping']:
+            if stat.get('StatCol') in stat_columns:
+                rows += conn.execute(f"SELECT COUNT(*) FROM guilds_users WHERE guild_id = ? AND {stat['StatCol']} != 0", (guild_id,)).fetchone()[0]
+    return rows
+
+
+def _estimate_leaderboard_indexes(conn):
+    # On a legacy database user_stats is only filled by migration 2, which has not run at plan time
+    rows = _legacy_stat_rows(conn)
+    for table in ('user_stats', 'guilds_emotes'):
+        if table_exists(conn, table):
+            rows += conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    return rows
+
+
+def _create_rollup_tables(conn, batch_size):
+    # Primary keys lead with (guild_id, stat_id, bucket) so period leaderboards read a single key range
+    conn.execute("""CREATE TABLE IF NOT EXISTS user_stats_hourly (
+                        guild_id integer NOT NULL,
+                        stat_id integer NOT NULL,
+                        hour integer NOT NULL,
+                        user_id integer NOT NULL,
+                        value integer NOT NULL DEFAULT 0,
+                        PRIMARY KEY (guild_id, stat_id, hour, user_id)
+                    ) WITHOUT ROWID""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS user_stats_daily (
+                        guild_id integer NOT NULL,
+                        stat_id integer NOT NULL,
+                        day integer NOT NULL,
+                        user_id integer NOT NULL,
+                        value integer NOT NULL DEFAULT 0,
+                        PRIMARY KEY (guild_id, stat_id, day, user_id)
+                    ) WITHOUT ROWID""")
+    # Compaction and retention select buckets by age across all guilds
+    conn.execute("CREATE INDEX IF NOT EXISTS user_stats_hourly_hour_idx ON user_stats_hourly(hour)")
+    conn.execute("CREATE INDEX IF NOT EXISTS user_stats_daily_day_idx ON user_stats_daily(day)")
+    conn.commit()
+    yield 0
+
+
+def _add_commands_hash(conn, batch_size):
+    if 'commands_hash' not in [row[1] for row in conn.execute("PRAGMA table_info(guilds)")]:
+        conn.execute("ALTER TABLE guilds ADD COLUMN commands_hash text DEFAULT NULL")
+    conn.commit()
+    yield 0
+
+
+MIGRATIONS = [
+    Migration(1, "Create guilds and guilds_emotes tables", _create_base_tables, _no_rows),
+    Migration(2, "Move stats from guilds_users columns into user_stats", _create_user_stats, _estimate_user_stats),
+    Migration(3, "Create backfill job tables", _create_backfill_tables, _no_rows),
+    Migration(4, "Create leaderboard indexes", _create_leaderboard_indexes, _estimate_leaderboard_indexes),
+    Migration(5, "Create hourly and daily stat rollup tables", _create_rollup_tables, _no_rows),
+    Migration(6, "Store the hash of the command tree last synced to each guild", _add_commands_hash, _no_rows),
+]
+
+
+def pending_migrations(conn):
+    version = get_version(conn)
+    return [migration for migration in MIGRATIONS if migration.version > version]
+
+
+def plan(conn):
+    """Dry run: return (version, description, estimated rows touched) of every pending migration without changing anything."""
+    return [(migration.version, migration.description, migration.estimate(conn)) for migration in pending_migrations(conn)]
+
+
+def iter_migrate(conn, batch_size=1000):
+    """Apply pending migrations in order, yielding (version, rows) after every committed batch. The schema version is
+    recorded in user_version as soon as each migration completes. Migrations commit at most batch_size rows at a time,
+    so a caller sharing the database with a live bot can pause between batches and never hold the write lock for long."""
+    for migration in pending_migrations(conn):
+        try:
+            for rows in migration.apply(conn, batch_size):
+                yield migration.version, rows
+        except Exception:
+            conn.rollback()
+            raise
+        _set_version(conn, migration.version)
+
+
+def migrate(conn, batch_size=1000):
+    """Apply pending migrations without pausing between batches. Returns the number of rows touched."""
+    return sum(rows for _, rows in iter_migrate(conn, batch_size))
@@ -0,0 +1,106 @@
+"""Opt-in profiling of app commands and event handlers"""
+
+import cProfile
+import os
+import time
+from contextvars import ContextVar
+from functools import wraps
+from os.path import join
+from random import random
+
+
+# Profiling is enabled with LEADERBOARDS_BOT_PROFILE=1. Invocations slower than the threshold are logged with the time
+# spent in each phase. Commands listed in LEADERBOARDS_BOT_PROFILE_COMMANDS are also run under cProfile for a sampled
+# fraction of invocations, and the stats are dumped to LEADERBOARDS_BOT_PROFILE_DIR.
+ENABLED = os.getenv('LEADERBOARDS_BOT_PROFILE') == '1'
+THRESHOLD = float(os.getenv('LEADERBOARDS_BOT_PROFILE_THRESHOLD_MS') or 500) / 1000
+PROFILE_COMMANDS = {name.strip() for name in (os.getenv('LEADERBOARDS_BOT_PROFILE_COMMANDS') or '').split(',') if name.strip()}
+SAMPLE_RATE = float(os.getenv('LEADERBOARDS_BOT_PROFILE_SAMPLE_RATE') or 0.1)
+PROFILE_DIR = os.getenv('LEADERBOARDS_BOT_PROFILE_DIR') or join(os.getcwd(), "profiles")
+
+# Timed kinds reported as phases of an invocation, see metrics.timer
+PHASES = ('db', 'rest', 'render')
+
+_current = ContextVar('profiling_invocation', default=None)
+_profiler_active = False
+
+
+class Invocation:
+    """Time spent per phase by one command or event handler invocation, including tasks it spawns.
+    Only the outermost timer of a phase counts, so nested database helpers are not counted twice."""
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.active = set()
+
+
+def enter_phase(kind):
+    """Return the current invocation if a timer of this kind starting now should be counted towards it, else None."""
+    invocation = _current.get()
+    if invocation is None or kind not in invocation.phases or kind in invocation.active:
+        return None
+    invocation.active.add(kind)
+    return invocation
+
+
+def exit_phase(invocation, kind, seconds):
+    invocation.phases[kind] += seconds
+    invocation.active.discard(kind)
+
+
+def _start_profiler(name):
+    global _profiler_active
+    if _profiler_active or name not in PROFILE_COMMANDS or random() >= SAMPLE_RATE:
+        return None
+
+    # cProfile traces the whole thread, so other tasks running meanwhile show up in the dump too
+    profiler = cProfile.Profile()
+    profiler.enable()
+    _profiler_active = True
+    return profiler
+
+
+def _stop_profiler(profiler, name):
+    global _profiler_active
+    profiler.disable()
+    _profiler_active = False
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof")
+        profiler.dump_stats(path)
+        print(f"Saved profile of {name} to {path}")
+    except OSError as e:
+        print(f"Failed to save profile of {name}. Error: {e}")
+
+
+def _log_slow(invocation, elapsed):
+    phases = ', '.join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in invocation.phases.items())
+    other = max(0.0, elapsed - sum(invocation.phases.values()))
+    print(f"Slow {invocation.kind} {invocation.name}: {elapsed * 1000:.0f}ms ({phases}, other {other * 1000:.0f}ms)")
+
+
+def profiled(kind, name=None):
+    """Decorator profiling every invocation of a coroutine function. Returns the function unchanged when disabled."""
+    def decorator(func):
+        if not ENABLED:
+            return func
+        invocation_name = name or func.__name__
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            invocation = Invocation(kind, invocation_name)
+            token = _current.set(invocation)
+            profiler = _start_profiler(invocation_name)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                if profiler is not None:
+                    _stop_profiler(profiler, invocation_name)
+                _current.reset(token)
+                if elapsed >= THRESHOLD:
+                    _log_slow(invocation, elapsed)
+        return wrapper
+    return decorator
@@ -0,0 +1,70 @@
+"""Cache of rendered leaderboard and stat list text"""
+
+import time
+from collections import OrderedDict
+
+
+class RenderCache:
+    """LRU cache of rendered text keyed by (guild_id, stat_id, view), where view is a leaderboard period or 'stats'.
+
+    Each stat has a write count, bumped by every increment, and a generation, bumped when its values are replaced or
+    it is removed. Guild wide changes, like the stat mapping, bump the generation of every stat of the guild. An entry
+    is served for `freshness` seconds after rendering as long as its generation is current, so busy stats are not
+    re-rendered on every call, and for up to `max_age` seconds while nothing about it changed."""
+    def __init__(self, max_size=1000, freshness=5.0, max_age=300.0):
+        self.max_size = max_size
+        self.freshness = freshness
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.writes = {}
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def version(self, guild_id, stat_id, extra=None):
+        """Return the version to render under. Read it before reading the data, so writes made while rendering
+        make the rendered entry stale. extra holds anything else the view depends on."""
+        generation = self.generations.get((guild_id, None), 0)
+        if stat_id is not None:
+            generation += self.generations.get((guild_id, stat_id), 0)
+        return generation, self.writes.get((guild_id, stat_id), 0), extra
+
+
+    def get(self, key, version):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry_version, value, rendered_at = entry
+            age = time.monotonic() - rendered_at
+            if entry_version[0] == version[0] and (age <= self.freshness or (entry_version == version and age <= self.max_age)):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+
+        self.misses += 1
+        return None
+
+
+    def put(self, key, version, value):
+        self.entries[key] = (version, value, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+    def bump(self, guild_id, stat_id):
+        key = (guild_id, stat_id)
+        self.writes[key] = self.writes.get(key, 0) + 1
+
+
+    def invalidate(self, guild_id, stat_id=None):
+        """Stop serving the stat's entries, or every entry of the guild if stat_id is None."""
+        key = (guild_id, stat_id)
+        self.generations[key] = self.generations.get(key, 0) + 1
+        for entry_key in [entry_key for entry_key in self.entries if entry_key[0] == guild_id and (stat_id is None or entry_key[1] == stat_id)]:
+            del self.entries[entry_key]
+
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
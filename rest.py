@@ -0,0 +1,200 @@
+"""Coalescing and prioritisation of Discord REST calls, with rate limit statistics per route"""
+
+import asyncio
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+import metrics
+
+
+# Interactive work is anything done on behalf of a command or gateway event. Background work, command syncs and every
+# history request of a backfill, waits while interactive work is in flight, for at most max_wait seconds, and pauses
+# after a rate limit.
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+_ID = re.compile(r'\d{15,}')
+_API_PREFIX = re.compile(r'^https?://[^/]+/api/v\d+')
+
+
+def route_of(url):
+    """Return the route template of a REST url, e.g. /guilds/{id}/emojis/{id}, so calls for different objects share stats."""
+    return _ID.sub('{id}', _API_PREFIX.sub('', url.split('?')[0]))
+
+
+class RouteStats:
+    def __init__(self):
+        self.rate_limits = 0
+        self.retry_after_total = 0.0
+        self.retry_after_max = 0.0
+        self.last = None
+
+
+class RestScheduler:
+    """Merges identical REST calls in flight into one, and holds background calls back while interactive work runs.
+    Discord.py still handles the rate limits themselves, this only keeps background work from competing for them."""
+    def __init__(self, background_concurrency=2, max_wait=5.0):
+        self.background_concurrency = background_concurrency
+        self.max_wait = max_wait
+        self.inflight = {}
+        self.interactive_active = 0
+        self.background_active = 0
+        self.background_waiting = 0
+        self.paused_until = 0.0
+        self.idle = asyncio.Event()
+        self.calls = 0
+        self.coalesced = 0
+        self.background_wait_time = 0.0
+        self.routes = {}
+
+
+    def _wake(self):
+        self.idle.set()
+        self.idle = asyncio.Event()
+
+
+    @asynccontextmanager
+    async def interactive(self):
+        self.interactive_active += 1
+        try:
+            yield
+        finally:
+            self.interactive_active -= 1
+            if self.interactive_active == 0:
+                self._wake()
+
+
+    async def wait_turn(self, limited=True):
+        """Wait until background work may issue its next call. Unless limited is False, the call also has to fit in
+        background_concurrency."""
+        started = time.monotonic()
+        self.background_waiting += 1
+        try:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                # Interactive work only holds background work back for max_wait, so it can not starve
+                yielding = self.interactive_active > 0 and now - started < self.max_wait
+                if not yielding and (not limited or self.background_active < self.background_concurrency):
+                    break
+                try:
+                    await asyncio.wait_for(self.idle.wait(), max(0.0, self.max_wait - (now - started)) if yielding else None)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.background_waiting -= 1
+            self.background_wait_time += time.monotonic() - started
+
+
+    @asynccontextmanager
+    async def background(self, limited=True):
+        """Hold a background turn. Only limited holders take one of the background_concurrency slots."""
+        await self.wait_turn(limited)
+        if not limited:
+            yield
+            return
+
+        self.background_active += 1
+        try:
+            yield
+        finally:
+            self.background_active -= 1
+            self._wake()
+
+
+    async def _run(self, factory, priority, limited):
+        if priority == BACKGROUND:
+            async with self.background(limited):
+                return await factory()
+        return await factory()
+
+
+    async def call(self, key, factory, priority=INTERACTIVE, limited=True):
+        """Await factory(), or the call already in flight under the same key, a tuple starting with the call's name,
+        e.g. ('fetch_user', user_id). Every caller gets the same result or exception. A caller being cancelled does
+        not cancel the call for the others. Background calls with limited False are bounded by the caller instead of
+        background_concurrency."""
+        self.calls += 1
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(factory, priority, limited))
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.coalesced += 1
+            if metrics.ENABLED:
+                metrics.REGISTRY.inc('leaderboards_rest_coalesced_total', (('call', key[0]),))
+        return await asyncio.shield(task)
+
+
+    def _done(self, key, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        # Mark the exception retrieved, the callers that are still waiting get it from shield
+        if not task.cancelled():
+            task.exception()
+
+
+    def record_rate_limit(self, route, retry_after, is_global=False):
+        """Count a 429 response on the route and pause background work until the limit resets."""
+        stats = self.routes.get(route)
+        if stats is None:
+            stats = self.routes[route] = RouteStats()
+        stats.rate_limits += 1
+        stats.retry_after_total += retry_after
+        stats.retry_after_max = max(stats.retry_after_max, retry_after)
+        stats.last = time.time()
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        if metrics.ENABLED:
+            metrics.REGISTRY.inc('leaderboards_rest_rate_limits_total', (('route', route), ('global', str(is_global).lower())))
+            metrics.REGISTRY.inc('leaderboards_rest_retry_after_seconds_total', (('route', route),), retry_after)
+
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'inflight': len(self.inflight),
+            'interactive_active': self.interactive_active,
+            'background_active': self.background_active,
+            'background_waiting': self.background_waiting,
+            'background_wait_time': self.background_wait_time,
+            'paused_for': max(0.0, self.paused_until - time.monotonic()),
+            'rate_limits': {route: {'count': stats.rate_limits, 'retry_after_total': stats.retry_after_total,
+                                    'retry_after_max': stats.retry_after_max, 'last': stats.last}
+                            for route, stats in self.routes.items()}
+        }
+
+
+class RateLimitHandler(logging.Handler):
+    """Feeds the 429 responses discord.py logs to a RestScheduler. Discord.py retries them itself and does not
+    expose them otherwise."""
+    def __init__(self, scheduler):
+        super().__init__(logging.WARNING)
+        self.scheduler = scheduler
+
+
+    def emit(self, record):
+        try:
+            if record.msg.startswith('We are being rate limited.'):
+                _method, url, retry_after = record.args[:3]
+                self.scheduler.record_rate_limit(route_of(str(url)), float(retry_after))
+            elif record.msg.startswith('Global rate limit has been hit.'):
+                self.scheduler.record_rate_limit('global', float(record.args[0]), True)
+        except Exception as e:
+            print(f"Failed to record rate limit. Error: {e}")
+
+
+def watch_rate_limits(scheduler):
+    """Start recording the rate limits discord.py hits into scheduler. Returns the handler."""
+    handler = RateLimitHandler(scheduler)
+    logger = logging.getLogger('discord.http')
+    logger.addHandler(handler)
+    # The handler needs warnings even if logging is not configured
+    if logger.getEffectiveLevel() > logging.WARNING:
+        logger.setLevel(logging.WARNING)
+    return handler
@@ -0,0 +1,84 @@
+"""Time-bucketed rollups of stat increments for period leaderboards"""
+
+import time
+
+
+# Period name -> number of UTC days it covers, including the current one
+PERIODS = {
+    'day': 1,
+    'week': 7,
+    'month': 30
+}
+
+PERIOD_NAMES = {
+    'day': "Today",
+    'week': "Last 7 days",
+    'month': "Last 30 days"
+}
+
+
+def hour_bucket(timestamp=None):
+    return int(time.time() if timestamp is None else timestamp) // 3600
+
+
+def record(conn, increments):
+    """Add (guild_id, stat_id, hour, user_id, amount) increments to the hourly rollup. The caller commits."""
+    conn.executemany("""INSERT INTO user_stats_hourly(guild_id, stat_id, hour, user_id, value) VALUES (?,?,?,?,?)
+                        ON CONFLICT(guild_id, stat_id, hour, user_id) DO UPDATE SET value = value + excluded.value""", increments)
+
+
+def compact(conn, keep_hours, keep_days, batch_size=1000, now=None):
+    """Fold hourly buckets older than keep_hours into daily buckets, one hour per transaction, then delete daily buckets
+    older than keep_days in batches of batch_size rows. Returns the number of rows moved or deleted."""
+    current_hour = hour_bucket(now)
+    rows = 0
+
+    hours = [row[0] for row in conn.execute("SELECT DISTINCT hour FROM user_stats_hourly WHERE hour < ? ORDER BY hour",
+                                            (current_hour - keep_hours,))]
+    for hour in hours:
+        try:
+            conn.execute("""INSERT INTO user_stats_daily(guild_id, stat_id, day, user_id, value)
+                            SELECT guild_id, stat_id, hour / 24, user_id, value FROM user_stats_hourly WHERE hour = ? AND true
+                            ON CONFLICT(guild_id, stat_id, day, user_id) DO UPDATE SET value = value + excluded.value""", (hour,))
+            rows += conn.execute("DELETE FROM user_stats_hourly WHERE hour = ?", (hour,)).rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    oldest_day = current_hour // 24 - keep_days
+    while True:
+        deleted = conn.execute("""DELETE FROM user_stats_daily WHERE (guild_id, stat_id, day, user_id) IN
+                                      (SELECT guild_id, stat_id, day, user_id FROM user_stats_daily WHERE day < ? LIMIT ?)""",
+                               (oldest_day, batch_size)).rowcount
+        conn.commit()
+        rows += deleted
+        if deleted < batch_size:
+            break
+
+    return rows
+
+
+def get_period_rows(conn, guild_id, stat_id, period, limit=10, now=None):
+    """Return the top (user_id, total) rows of a stat over a period. Only buckets from the period's first UTC day onwards
+    are read, through their (guild_id, stat_id, bucket) primary keys, so the cost is bounded by the period, not all time.
+    An hour is either still hourly or already folded into its day, and both tables are cut at the same day boundary,
+    so every increment is counted exactly once."""
+    first_day = hour_bucket(now) // 24 - PERIODS[period] + 1
+    sql = """SELECT user_id, SUM(value) AS total FROM (
+                 SELECT user_id, value FROM user_stats_daily WHERE guild_id = ? AND stat_id = ? AND day >= ?
+                 UNION ALL
+                 SELECT user_id, value FROM user_stats_hourly WHERE guild_id = ? AND stat_id = ? AND hour >= ?
+             ) GROUP BY user_id ORDER BY total DESC LIMIT ?"""
+    return conn.execute(sql, (guild_id, stat_id, first_day, guild_id, stat_id, first_day * 24, limit)).fetchall()
+
+
+def purge_stat(conn, guild_id, stat_id, batch_size=1000):
+    """Delete up to batch_size rollup rows of a deleted stat from each rollup table. Returns the number of rows deleted."""
+    deleted = 0
+    for table, bucket in (('user_stats_hourly', 'hour'), ('user_stats_daily', 'day')):
+        deleted += conn.execute(f"""DELETE FROM {table} WHERE (guild_id, stat_id, {bucket}, user_id) IN
+                                        (SELECT guild_id, stat_id, {bucket}, user_id FROM {table} WHERE guild_id = ? AND stat_id = ? LIMIT ?)""",
+                                (guild_id, stat_id, batch_size)).rowcount
+    conn.commit()
+    return deleted
@@ -0,0 +1,71 @@
+"""In-memory tracking of user activity for slowmode checks"""
+
+import time
+
+
+class SlowModeTracker:
+    """Last activity timestamp per (channel_id, user_id), recorded from messages and completed commands.
+    An entry is only useful until the channel's slowmode delay has passed, so it expires then and is swept periodically.
+    A channel is warm once it has been tracked for at least its delay; before that, activity from before tracking
+    started may be missing and callers must fall back to reading the channel's history. A channel whose entries have
+    all expired is dropped by the sweep too, and is cold again on its next check."""
+    def __init__(self, sweep_interval=60):
+        self.sweep_interval = sweep_interval
+        self.last_activity = {}
+        self.tracking_since = {}
+        self.last_sweep = time.time()
+        self.hits = 0
+        self.cold = 0
+
+
+    def record(self, channel_id, user_id, delay, timestamp=None):
+        """Record activity of a user in a channel with the given slowmode delay. Channels without slowmode are not tracked."""
+        if not delay or delay <= 0:
+            return
+
+        timestamp = time.time() if timestamp is None else timestamp
+        self.tracking_since.setdefault(channel_id, timestamp)
+        self.last_activity[(channel_id, user_id)] = (timestamp, timestamp + delay)
+        if timestamp - self.last_sweep >= self.sweep_interval:
+            self.sweep(timestamp)
+
+
+    def remaining(self, channel_id, user_id, delay, now=None):
+        """Return the seconds the user must still wait in the channel, 0 if none, or None if the channel is still cold."""
+        now = time.time() if now is None else now
+        since = self.tracking_since.get(channel_id)
+        if since is None or now - since < delay:
+            self.cold += 1
+            return None
+
+        self.hits += 1
+        entry = self.last_activity.get((channel_id, user_id))
+        if entry is None:
+            return 0
+        return max(0, entry[0] + delay - now)
+
+
+    def warm(self, channel_id, delay, activity, now=None):
+        """Seed a cold channel from (user_id, timestamp) activity read from its history over the last delay seconds.
+        The channel then counts as tracked for the whole window, so its history is only read once."""
+        now = time.time() if now is None else now
+        for user_id, timestamp in activity:
+            entry = self.last_activity.get((channel_id, user_id))
+            if entry is None or entry[0] < timestamp:
+                self.last_activity[(channel_id, user_id)] = (timestamp, timestamp + delay)
+        since = self.tracking_since.get(channel_id)
+        self.tracking_since[channel_id] = now - delay if since is None else min(since, now - delay)
+
+
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        for key in [key for key, (_, expires) in self.last_activity.items() if expires <= now]:
+            del self.last_activity[key]
+        active_channels = {channel_id for channel_id, _ in self.last_activity}
+        for channel_id in [channel_id for channel_id in self.tracking_since if channel_id not in active_channels]:
+            del self.tracking_since[channel_id]
+        self.last_sweep = now
+
+
+    def stats(self):
+        return {'entries': len(self.last_activity), 'channels': len(self.tracking_since), 'hits': self.hits, 'cold': self.cold}
@@ -0,0 +1,61 @@
+"""Write-behind buffering of user stat increments"""
+
+import time
+import database
+import rollups
+
+
+class StatBuffer:
+    """Accumulates stat increments in memory, keyed by (guild_id, user_id, stat_id), and writes them to user_stats
+    in a single transaction once either max_pending keys are buffered or the oldest increment is max_staleness seconds old.
+    The same increments are also bucketed by hour and written to the hourly rollup in that transaction."""
+    def __init__(self, max_pending=500, max_staleness=5.0):
+        self.max_pending = max_pending
+        self.max_staleness = max_staleness
+        self.pending = {}
+        self.hourly = {}
+        self.oldest = None
+        self.flushes = 0
+        self.rows_flushed = 0
+
+
+    def add(self, guild_id, user_id, stat_id, amount=1):
+        key = (guild_id, user_id, stat_id)
+        self.pending[key] = self.pending.get(key, 0) + amount
+        hourly_key = (guild_id, stat_id, rollups.hour_bucket(), user_id)
+        self.hourly[hourly_key] = self.hourly.get(hourly_key, 0) + amount
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+
+    def should_flush(self):
+        if not self.pending:
+            return False
+        return len(self.pending) >= self.max_pending or time.monotonic() - self.oldest >= self.max_staleness
+
+
+    def flush(self, conn):
+        """Write all buffered increments with one executemany, committed as one transaction.
+        On failure the increments are kept so they can be retried on the next flush."""
+        if not self.pending:
+            return 0
+
+        try:
+            database.upsert_user_stats(conn, [(guild_id, stat_id, user_id, amount) for (guild_id, user_id, stat_id), amount in self.pending.items()], add=True)
+            rollups.record(conn, [(*key, amount) for key, amount in self.hourly.items()])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        flushed = len(self.pending)
+        self.pending = {}
+        self.hourly = {}
+        self.oldest = None
+        self.flushes += 1
+        self.rows_flushed += flushed
+        return flushed
+
+
+    def stats(self):
+        return {'pending': len(self.pending), 'flushes': self.flushes, 'rows_flushed': self.rows_flushed}
@@ -0,0 +1,41 @@
+"""Compiled lookup tables for matching events to tracked stats"""
+
+
+ALL_LEVELS = ('Guild', 'Category', 'Channel')
+
+
+def _stat_key(stat_type, level, level_id, dice_type=None, target=None):
+    if stat_type == 'Dice':
+        return stat_type, level, level_id, dice_type, target
+    return stat_type, level, level_id
+
+
+class StatIndex:
+    """A guild's stat mapping compiled into a dict keyed by (Type, Level, LevelID), extended with (DiceType, Target) for dice stats.
+    Matching an event costs one dict lookup per level regardless of how many stats the guild tracks, and yields StatIDs."""
+    def __init__(self, stat_mapping):
+        self.table = {}
+        for stat in stat_mapping['Mapping']:
+            level_id = None if stat['Level'] == 'Guild' else stat['LevelID']
+            key = _stat_key(stat['Type'], stat['Level'], level_id, stat.get('DiceType'), stat.get('Target'))
+            self.table.setdefault(key, []).append(stat['StatID'])
+
+
+    def get(self, channel, stat_type, levels=ALL_LEVELS, dice_type=None, dice_result=None):
+        if not self.table:
+            return []
+
+        stat_ids = []
+        for level in levels:
+            if level == 'Guild':
+                level_id = None
+            elif level == 'Category':
+                level_id = channel.category_id
+            else:
+                level_id = channel.id
+
+            ids = self.table.get(_stat_key(stat_type, level, level_id, dice_type, dice_result))
+            if ids:
+                stat_ids.extend(ids)
+
+        return stat_ids
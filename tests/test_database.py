@@ -0,0 +1,51 @@
+import sqlite3
+import backfill
+import database
+import migrations
+import stat_buffer
+
+
+def create_db():
+    conn = sqlite3.connect(':memory:')
+    migrations.migrate(conn)
+    return conn
+
+
+def read_stats(conn):
+    return conn.execute("SELECT guild_id, stat_id, user_id, value FROM user_stats ORDER BY guild_id, stat_id, user_id").fetchall()
+
+
+def test_upsert_user_stats_sets_values():
+    conn = create_db()
+    database.upsert_user_stats(conn, [(1, 1, 10, 5), (1, 2, 10, 7)])
+    assert database.upsert_user_stats(conn, [(1, 1, 10, 3), (1, 1, 11, 4)]) == 2
+    conn.commit()
+    assert read_stats(conn) == [(1, 1, 10, 3), (1, 1, 11, 4), (1, 2, 10, 7)]
+
+
+def test_upsert_user_stats_adds_values():
+    conn = create_db()
+    database.upsert_user_stats(conn, [(1, 1, 10, 5)], add=True)
+    assert database.upsert_user_stats(conn, [(1, 1, 10, 3), (2, 1, 10, 4)], add=True) == 2
+    conn.commit()
+    assert read_stats(conn) == [(1, 1, 10, 8), (2, 1, 10, 4)]
+
+
+def test_stat_buffer_flush_adds_to_stored_values():
+    conn = create_db()
+    database.upsert_user_stats(conn, [(1, 1, 10, 5)])
+    buffer = stat_buffer.StatBuffer()
+    buffer.add(1, 10, 1)
+    buffer.add(1, 10, 1)
+    buffer.add(1, 11, 1)
+    assert buffer.flush(conn) == 2
+    assert read_stats(conn) == [(1, 1, 10, 7), (1, 1, 11, 1)]
+
+
+def test_finish_job_sets_stats_to_counted_totals():
+    conn = create_db()
+    database.upsert_user_stats(conn, [(1, 1, 10, 5), (1, 2, 10, 9)])
+    job_id = backfill.create_job(conn, 1, 'Guild', 1, [1, 2], None, [100])
+    backfill.checkpoint(conn, job_id, 100, 1000, {10: 2, 11: 3}, done=True)
+    assert backfill.finish_job(conn, job_id, 1, [1, 2]) == 4
+    assert read_stats(conn) == [(1, 1, 10, 2), (1, 1, 11, 3), (1, 2, 10, 2), (1, 2, 11, 3)]
@@ -0,0 +1,15 @@
+from emoji_registry import parse_custom_emoji_ids
+
+
+def test_parse_custom_emoji_ids():
+    content = "<:wave:123> hi <a:dance:456> <:wave:123>"
+    assert parse_custom_emoji_ids(content) == [123, 456]
+
+
+def test_parse_custom_emoji_ids_ignores_malformed_tokens():
+    content = "<:x:> <::> <:x:12a> <:pog:789> <:nodigits:abc>"
+    assert parse_custom_emoji_ids(content) == [789]
+
+
+def test_parse_custom_emoji_ids_without_emojis():
+    assert parse_custom_emoji_ids("no emojis here :smile: <@123>") == []
@@ -0,0 +1,21 @@
+import asyncio
+import ingestion
+
+
+def test_spilled_records_refill_a_queue_of_one(tmp_path):
+    async def run():
+        processed = []
+
+        async def handler(record):
+            processed.append(record.emoji_id)
+
+        queue = ingestion.IngestQueue(maxsize=1, policy='spill', spill_path=str(tmp_path / "spill.jsonl"))
+        for emoji_id in range(5):
+            await queue.put(ingestion.ReactionRecord(1, emoji_id, True))
+        assert queue.spilled == 4
+        queue.start(handler, 1)
+        await asyncio.wait_for(queue.queue.join(), 1)
+        await queue.stop()
+        return processed
+
+    assert asyncio.run(run()) == [0, 1, 2, 3, 4]
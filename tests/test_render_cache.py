@@ -0,0 +1,19 @@
+import render_cache
+
+
+def test_guild_wide_version_counts_the_guild_generation_once():
+    cache = render_cache.RenderCache()
+    cache.invalidate(1)
+    assert cache.version(1, None)[0] == 1
+    cache.invalidate(1, 5)
+    assert cache.version(1, None)[0] == 1
+    assert cache.version(1, 5)[0] == 2
+
+
+def test_invalidating_the_guild_stops_serving_its_entries():
+    cache = render_cache.RenderCache()
+    version = cache.version(1, None)
+    cache.put((1, None, 'stats'), version, "stats")
+    assert cache.get((1, None, 'stats'), cache.version(1, None)) == "stats"
+    cache.invalidate(1)
+    assert cache.get((1, None, 'stats'), cache.version(1, None)) is None
@@ -0,0 +1,47 @@
+import asyncio
+import rest
+
+
+def test_unlimited_background_holder_does_not_block_limited_work():
+    async def run():
+        scheduler = rest.RestScheduler(background_concurrency=1)
+        release = asyncio.Event()
+        entered = asyncio.Event()
+
+        async def hold_unlimited():
+            async with scheduler.background(limited=False):
+                entered.set()
+                await release.wait()
+
+        holder = asyncio.create_task(hold_unlimited())
+        await entered.wait()
+        assert scheduler.background_active == 0
+        async with scheduler.background():
+            assert scheduler.background_active == 1
+        release.set()
+        await holder
+
+    asyncio.run(asyncio.wait_for(run(), 1))
+
+
+def test_limited_background_work_waits_for_a_slot():
+    async def run():
+        scheduler = rest.RestScheduler(background_concurrency=1)
+        release = asyncio.Event()
+        entered = asyncio.Event()
+
+        async def hold_limited():
+            async with scheduler.background():
+                entered.set()
+                await release.wait()
+
+        holder = asyncio.create_task(hold_limited())
+        await entered.wait()
+        waiter = asyncio.create_task(scheduler.wait_turn())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        release.set()
+        await holder
+        await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(run())
@@ -0,0 +1,18 @@
+import slow_mode
+
+
+def test_sweep_drops_channels_without_activity():
+    tracker = slow_mode.SlowModeTracker()
+    tracker.record(1, 10, 30, timestamp=100)
+    tracker.record(2, 10, 300, timestamp=100)
+    tracker.sweep(now=200)
+    assert list(tracker.tracking_since) == [2]
+    assert tracker.remaining(1, 10, 30, now=200) is None
+    assert tracker.remaining(2, 10, 300, now=500) == 0
+
+
+def test_remaining_waits_for_the_delay():
+    tracker = slow_mode.SlowModeTracker()
+    tracker.warm(1, 60, [(10, 100)], now=120)
+    assert tracker.remaining(1, 10, 60, now=120) == 40
+    assert tracker.remaining(1, 11, 60, now=120) == 0
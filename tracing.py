@@ -0,0 +1,78 @@
+"""Recording of handled gateway events to compact trace files for replay"""
+
+import gzip
+import hmac
+import os
+import time
+from hashlib import sha256
+from json import loads, dumps
+
+
+# Event kinds as stored in a trace, one JSON array per line starting with [milliseconds since start, kind, ...]
+MESSAGE = 'm'               # guild_id, channel_id, category_id, user_id, slowmode_delay, emoji_ids
+REACTION_ADD = 'r+'         # guild_id, emoji_id
+REACTION_REMOVE = 'r-'      # guild_id, emoji_id
+COMMAND = 'c'               # guild_id, channel_id, category_id, user_id, slowmode_delay, command name
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+class TraceRecorder:
+    """Appends the events the bot handles to path, gzip compressed if it ends in .gz. Message content is never stored,
+    only the ids of the custom emojis in it. With anonymize, every id is replaced by a keyed hash, so the trace keeps
+    which events share a guild, channel, user or emoji without revealing them. Without a salt, the key is random
+    and ids can not be linked across recordings."""
+    def __init__(self, path, anonymize=False, salt=None):
+        self.path = path
+        self.anonymize = anonymize
+        self.key = (salt.encode() if salt else os.urandom(16)) if anonymize else None
+        self.file = _open(path, 'a')
+        self.started = time.monotonic()
+        self.events = 0
+
+
+    def _id(self, value):
+        if value is None or self.key is None:
+            return value
+        return int.from_bytes(hmac.new(self.key, str(value).encode(), sha256).digest()[:8], 'big') >> 1
+
+
+    def _write(self, kind, *fields):
+        self.file.write(dumps([int((time.monotonic() - self.started) * 1000), kind, *fields], separators=(',', ':')) + '\n')
+        self.events += 1
+
+
+    def message(self, guild_id, channel_id, category_id, user_id, slowmode_delay, emoji_ids):
+        self._write(MESSAGE, self._id(guild_id), self._id(channel_id), self._id(category_id), self._id(user_id), slowmode_delay,
+                    [self._id(emoji_id) for emoji_id in emoji_ids])
+
+
+    def reaction(self, guild_id, emoji_id, added):
+        self._write(REACTION_ADD if added else REACTION_REMOVE, self._id(guild_id), self._id(emoji_id))
+
+
+    def command(self, guild_id, channel_id, category_id, user_id, slowmode_delay, name):
+        self._write(COMMAND, self._id(guild_id), self._id(channel_id), self._id(category_id), self._id(user_id), slowmode_delay, name)
+
+
+    def flush(self):
+        self.file.flush()
+
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(path):
+    """Yield the events of a trace as lists, in recorded order."""
+    with _open(path, 'r') as f:
+        for line in f:
+            try:
+                yield loads(line)
+            except ValueError:
+                # A trace of a process that was killed can end in a partly written line
+                break
@@ -0,0 +1,39 @@
+"""Cache of resolved usernames"""
+
+import time
+from collections import OrderedDict
+
+
+class UserNameCache:
+    """LRU cache of user_id -> username whose entries expire after ttl seconds.
+    Deleted users are cached too, under the name the caller stores for them."""
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            if entry is not None:
+                del self.entries[user_id]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+
+    def put(self, user_id, name):
+        self.entries[user_id] = (name, time.monotonic())
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}